@@ -1,21 +1,39 @@
+import json
 import os
-from google.auth.transport.requests import Request
+import threading
+import time
+import google.auth.credentials
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from helper import save_json_file
+from logger import logger
+from transport import DEFAULT_TRANSPORT, build_transport
 
+SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
+          'https://www.googleapis.com/auth/spreadsheets',
+          'https://www.googleapis.com/auth/documents',
+          "https://www.googleapis.com/auth/drive"]
 
-def get_authenticated_services():
-    SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
-              'https://www.googleapis.com/auth/spreadsheets',
-              'https://www.googleapis.com/auth/documents',
-              "https://www.googleapis.com/auth/drive"]
+TOKEN_FILE = "token.json"
 
+# (name, version) of each API client, in the order get_authenticated_services returns them
+API_VERSIONS = [('gmail', 'v1'), ('sheets', 'v4'), ('drive', 'v3'), ('docs', 'v1')]
+
+# Parsed discovery documents by (name, version), shared by every client built in this process
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+
+def get_credentials(token_file=TOKEN_FILE):
     creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
+        # Imported here as they are only needed when the stored token is unusable
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
@@ -24,12 +42,130 @@ def get_authenticated_services():
             creds = flow.run_local_server(
                 port=0, access_type='offline', prompt='consent')
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
+        with open(token_file, "w") as token:
             token.write(creds.to_json())
+    return creds
+
+
+class SharedCredentials(google.auth.credentials.Credentials):
+    """
+    Wraps credentials shared by several threads so that an expired token is
+    refreshed once, under a lock, rather than by every worker that notices.
+    Refreshed tokens are saved to `token_file` for the next start.
+
+    It subclasses google-auth's Credentials so googleapiclient treats it as
+    such, but keeps no state of its own: everything comes from `creds`.
+    """
+
+    def __init__(self, creds, token_file=TOKEN_FILE):
+        self.credentials = creds
+        self.token_file = token_file
+        self.refresh_count = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Everything else (valid, expired, token, ...) comes from the wrapped credentials
+        return getattr(self.credentials, name)
+
+    @property
+    def valid(self):
+        return self.credentials.valid
+
+    @property
+    def expired(self):
+        return self.credentials.expired
+
+    def apply(self, headers, token=None):
+        self.credentials.apply(headers, token)
+
+    def before_request(self, request, method, url, headers):
+        if not self.credentials.valid:
+            self.refresh(request)
+        self.credentials.apply(headers)
+
+    def refresh(self, request):
+        stale_token = self.credentials.token
+        with self._lock:
+            # Another thread may have refreshed the token while this one waited
+            if self.credentials.token != stale_token and self.credentials.valid:
+                return
+            self.credentials.refresh(request)
+            self.refresh_count += 1
+            logger.info("Refreshed the access token")
+            if self.token_file and getattr(self.credentials, 'refresh_token', None):
+                save_json_file(self.token_file, json.loads(self.credentials.to_json()))
+
+
+def get_discovery_document(name, version):
+    # The discovery document bundled with the client library, read once per process
+    key = (name, version)
+    if key not in _discovery_documents:
+        with _discovery_lock:
+            if key not in _discovery_documents:
+                document = get_static_doc(name, version)
+                _discovery_documents[key] = json.loads(document) if document else None
+    return _discovery_documents[key]
+
+
+def build_service(name, version, http):
+    """
+    Builds an API client from the bundled discovery document, without fetching
+    it over the network (falls back to discovery for APIs that are not bundled).
+    """
+    start = time.perf_counter()
+    document = get_discovery_document(name, version)
+    if document is not None:
+        service = build_from_document(document, http=http)
+    else:
+        service = build(name, version, http=http, static_discovery=False, cache_discovery=False)
+    logger.info(f"Built the {name} {version} client in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return service
+
+
+class LazyService:
+    """
+    Stands in for an API client and builds it on first use, so a run only
+    pays for the clients it actually calls.
+    """
+
+    def __init__(self, name, version, http):
+        self.name = name
+        self.version = version
+        self.http = http
+        self._service = None
+        self._lock = threading.Lock()
+
+    def get_service(self):
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._service = build_service(self.name, self.version, self.http)
+        return self._service
+
+    def __getattr__(self, name):
+        return getattr(self.get_service(), name)
+
+
+def get_authenticated_services(creds=None, lazy=True, transport=DEFAULT_TRANSPORT, token_file=TOKEN_FILE,
+                               **pool_options):
+    """
+    Parameters:
+    - creds: Credentials to use (loaded with get_credentials if None).
+    - token_file (str): Where the token is stored and refreshed tokens are saved.
+    - lazy (bool): Build each client on first use instead of up front.
+    - transport (str): 'pooled' or 'per-thread', see transport.py.
+    - pool_options: Options for the pooled transport (pool_maxsize, timeout, ...).
 
-    gmail_service = build('gmail', 'v1', credentials=creds)
-    sheets_service = build('sheets', 'v4', credentials=creds)
-    drive_service = build("drive", "v3", credentials=creds)
-    docs_service = build('docs', 'v1', credentials=creds)
+    Returns:
+    - (gmail_service, sheets_service, drive_service, docs_service)
+    """
+    if creds is None:
+        creds = get_credentials(token_file)
+    if not isinstance(creds, SharedCredentials):
+        creds = SharedCredentials(creds, token_file)
 
-    return gmail_service, sheets_service, drive_service, docs_service
+    # One thread-safe Http object shared by every client and worker thread
+    http = build_transport(creds, transport, **pool_options)
+    if lazy:
+        return tuple(LazyService(name, version, http) for name, version in API_VERSIONS)
+    return tuple(build_service(name, version, http) for name, version in API_VERSIONS)
@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from auth import get_authenticated_services, get_credentials
+from concurrency import API_RATE_LIMITS, ApiWorkerPools, set_rate_limit
+from drive import LazyFolderDict
+from emails import get_message_ids_in_date_range
+from folder_cache import FolderCache
+from helper import get_main_path, get_spreadsheet_file_name
+from journal import JOURNAL_FILE, ExportJournal
+from logger import logger
+from message_cache import MESSAGE_CACHE_FILE, MessageCache
+from pipeline import run_email_pipeline
+from sinks import GoogleSink
+from spreadsheet import create_spreadsheet_in_folder, ensure_header_row
+
+# Backfills a long date range by splitting it into day or week shards that
+# run in parallel processes, e.g.
+#
+#   python backfill.py 2024/01/01 2025/01/01 --shard week --processes 4
+
+SHARD_SIZES = {'day': 1, 'week': 7}
+# Each shard records its own progress here, so finished shards are skipped on a rerun
+BACKFILL_CHECKPOINT_DIR = 'backfill_checkpoints'
+# Attempts per shard; later attempts only redo what the journal shows as unfinished
+SHARD_ATTEMPTS = 3
+SHARD_RETRY_DELAY = 10
+
+# (services_factory, services) of this process, reused by all its shards
+_process_services = None
+
+
+def split_date_range(start_date, end_date, shard_size='week'):
+    """
+    Splits a date range into consecutive shards.
+
+    Parameters:
+    - start_date (str): Start date in 'YYYY/MM/DD' format.
+    - end_date (str): End date in 'YYYY/MM/DD' format (exclusive).
+    - shard_size (str): 'day' or 'week'.
+
+    Returns:
+    - List of (start_date, end_date) tuples in 'YYYY/MM/DD' format.
+    """
+    step = timedelta(days=SHARD_SIZES[shard_size])
+    start = datetime.strptime(start_date, "%Y/%m/%d")
+    end = datetime.strptime(end_date, "%Y/%m/%d")
+    shards = []
+    while start < end:
+        shard_end = min(start + step, end)
+        shards.append((start.strftime("%Y/%m/%d"), shard_end.strftime("%Y/%m/%d")))
+        start = shard_end
+    return shards
+
+
+def get_shard_checkpoint_file(shard):
+    start_date, end_date = shard
+    name = f"{start_date}_{end_date}".replace("/", "-")
+    return os.path.join(BACKFILL_CHECKPOINT_DIR, f"{name}.json")
+
+
+def google_services():
+    # Default services factory; called once in the parent and once per worker process (see _get_services)
+    return get_authenticated_services(get_credentials())
+
+
+def prepare_folders(drive_service, sheet_service, start_date, end_date):
+    """
+    Creates every day folder, monthly spreadsheet folder, spreadsheet and
+    header row the range needs before any shard starts.
+
+    Shards in different processes cannot coordinate, so anything they might
+    both create is created once here instead. The folder IDs end up in the
+    shared folder cache file, which the shards load.
+    """
+    folder_dict = LazyFolderDict(FolderCache(drive_service, get_main_path()))
+    # Emails are filed by the date in their own time zone, so the first and
+    # last shard may also need a folder just outside the range; only one
+    # shard can need each of those, so they are left to be created lazily
+    day = datetime.strptime(start_date, "%Y/%m/%d")
+    end = datetime.strptime(end_date, "%Y/%m/%d")
+    months = set()
+    while day < end:
+        folder_dict[f"docs_day_{day:%d_%m_%Y}"]
+        months.add(f"{day:%m_%Y}")
+        day += timedelta(days=1)
+
+    for month in sorted(months):
+        sheet_folder_id_key = f"spreadsheet_{month}"
+        # Same name GoogleSink's row writer looks up for the month
+        spreadsheet_id = create_spreadsheet_in_folder(
+            drive_service, folder_dict, {'sheet_folder_id_key': sheet_folder_id_key},
+            get_spreadsheet_file_name(int(month.split("_")[0])))
+        if spreadsheet_id is None or isinstance(spreadsheet_id, dict):
+            raise RuntimeError(f"Could not create the spreadsheet for {month}")
+        ensure_header_row(sheet_service, spreadsheet_id)
+    logger.info(f"Prepared folders and spreadsheets for {len(months)} months")
+
+
+def _init_worker(processes, quota_share):
+    global _process_services
+    # The per-user quota is shared by all processes, so each gets its part of it
+    for api, rate in API_RATE_LIMITS.items():
+        set_rate_limit(api, rate * quota_share / processes)
+    # Never reuse services inherited from the parent, whose connections it still uses
+    _process_services = None
+
+
+def _get_services(services_factory):
+    # The first shard a process runs builds the services; later shards reuse them
+    global _process_services
+    if _process_services is None or _process_services[0] is not services_factory:
+        _process_services = (services_factory, services_factory())
+    return _process_services[1]
+
+
+def run_shard(shard, services_factory=google_services, journal_file=JOURNAL_FILE,
+              cache_file=MESSAGE_CACHE_FILE, attempts=SHARD_ATTEMPTS):
+    """
+    Exports one shard, retrying it when messages fail.
+
+    Returns:
+    - Dictionary with the shard, its 'status' ('done', 'skipped' or 'failed'),
+      the number of messages exported, the attempts made and the seconds taken.
+    """
+    start = time.monotonic()
+    result = {'shard': shard, 'status': 'failed', 'messages': 0, 'attempts': 0}
+    gmail_service, sheet_service, drive_service, docs_service = _get_services(services_factory)
+    checkpoint_file = get_shard_checkpoint_file(shard)
+
+    for attempt in range(1, attempts + 1):
+        result['attempts'] = attempt
+        try:
+            message_ids = get_message_ids_in_date_range(gmail_service, *shard, checkpoint_file)
+            if isinstance(message_ids, dict):
+                result['status'] = 'skipped' if attempt == 1 else 'done'
+                break
+            stats, exported = _export(gmail_service, sheet_service, drive_service, message_ids, journal_file, cache_file)
+            result['messages'] += exported
+            if not any(stage['errors'] for stage in stats.values()):
+                message_ids.commit()
+                result['status'] = 'done'
+                break
+            logger.warning(f"Shard {shard[0]} to {shard[1]} had failures (attempt {attempt}/{attempts})")
+        except Exception as error:
+            logger.exception(f"Shard {shard[0]} to {shard[1]} failed (attempt {attempt}/{attempts}): {error}")
+            result['error'] = str(error)
+        if attempt < attempts:
+            time.sleep(SHARD_RETRY_DELAY * 2 ** (attempt - 1))
+
+    result['seconds'] = round(time.monotonic() - start, 1)
+    return result
+
+
+def _export(gmail_service, sheet_service, drive_service, message_ids, journal_file, cache_file):
+    journal = ExportJournal(journal_file)
+    cache = MessageCache(cache_file) if cache_file else None
+    pools = ApiWorkerPools()
+    # Folders were created by prepare_folders, so these are cache hits
+    folder_dict = LazyFolderDict(FolderCache(drive_service, get_main_path()))
+    # Google only: shards in separate processes cannot share local export files
+    sink = GoogleSink(sheet_service, drive_service, folder_dict, pools, journal)
+    try:
+        # The journal drops messages already exported by an earlier attempt
+        stats = run_email_pipeline(gmail_service, message_ids, [sink], pools, journal=journal, cache=cache)
+        return stats, sink.written
+    finally:
+        sink.close()
+        journal.close()
+        if cache is not None:
+            cache.close()
+
+
+def run_backfill(start_date, end_date, shard_size='week', processes=None, quota_share=1.0,
+                 services_factory=google_services, journal_file=JOURNAL_FILE, cache_file=MESSAGE_CACHE_FILE):
+    """
+    Exports a date range as independent shards running in parallel processes.
+
+    Every shard has its own checkpoint, so a rerun skips the shards that
+    finished and resumes the others; the shared journal keeps messages from
+    being exported twice. The API rate limits are divided between the
+    processes so together they stay within the per-user quota.
+
+    Parameters:
+    - start_date (str): Start date in 'YYYY/MM/DD' format.
+    - end_date (str): End date in 'YYYY/MM/DD' format (exclusive).
+    - shard_size (str): 'day' or 'week'.
+    - processes (int): Worker processes (defaults to the CPU count, at most one per shard).
+    - quota_share (float): Fraction of the per-user API quota the backfill may use.
+    - services_factory: Picklable function returning the four API services.
+    - journal_file (str): SQLite journal shared by all shards.
+    - cache_file (str): SQLite message cache shared by all shards (None disables it).
+
+    Returns:
+    - Dictionary with the per-shard results and totals.
+    """
+    shards = split_date_range(start_date, end_date, shard_size)
+    processes = max(1, min(processes or os.cpu_count() or 1, len(shards)))
+    os.makedirs(BACKFILL_CHECKPOINT_DIR, exist_ok=True)
+    started = time.monotonic()
+
+    gmail_service, sheet_service, drive_service, docs_service = services_factory()
+    prepare_folders(drive_service, sheet_service, start_date, end_date)
+    # Create the shared SQLite files up front; processes creating the same
+    # tables at once would race
+    ExportJournal(journal_file).close()
+    if cache_file:
+        MessageCache(cache_file).close()
+    logger.info(f"Backfilling {start_date} to {end_date} as {len(shards)} {shard_size} shards "
+                f"in {processes} processes")
+
+    results = []
+
+    def report(result):
+        results.append(result)
+        elapsed = time.monotonic() - started
+        remaining = elapsed / len(results) * (len(shards) - len(results))
+        logger.info(f"Shard {result['shard'][0]} to {result['shard'][1]} {result['status']}: "
+                    f"{result['messages']} messages in {result.get('seconds', 0)}s "
+                    f"({len(results)}/{len(shards)} shards, about {remaining:.0f}s left)")
+
+    if processes == 1:
+        _init_worker(1, quota_share)
+        for shard in shards:
+            report(run_shard(shard, services_factory, journal_file, cache_file))
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(processes, quota_share)) as executor:
+            futures = [executor.submit(run_shard, shard, services_factory, journal_file, cache_file)
+                       for shard in shards]
+            for future in as_completed(futures):
+                report(future.result())
+
+    results.sort(key=lambda result: result['shard'])
+    summary = {
+        'shards': len(shards),
+        'failed': [result['shard'] for result in results if result['status'] == 'failed'],
+        'messages': sum(result['messages'] for result in results),
+        'seconds': round(time.monotonic() - started, 1),
+        'results': results,
+    }
+    logger.info(f"Backfill finished: {summary['messages']} messages in {summary['seconds']}s, "
+                f"{len(summary['failed'])} failed shards")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill a date range in parallel shards")
+    parser.add_argument("start_date", help="YYYY/MM/DD")
+    parser.add_argument("end_date", help="YYYY/MM/DD (exclusive)")
+    parser.add_argument("--shard", choices=sorted(SHARD_SIZES), default="week")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--quota-share", type=float, default=1.0)
+    args = parser.parse_args()
+
+    summary = run_backfill(args.start_date, args.end_date, args.shard, args.processes, args.quota_share)
+    print(json.dumps({key: value for key, value in summary.items() if key != 'results'}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrency import API_RATE_LIMITS, set_rate_limit
+from emails import parse_email_details
+from logger import logger
+from synthetic_mail import MESSAGE_SHAPES, make_corpus
+
+# Offline benchmarks; run with `python benchmark.py parse --help` or
+# `python benchmark.py e2e --help`
+
+E2E_SIZES = [100, 10000, 100000]
+
+# Run in a fresh interpreter by bench_startup: imports, credentials and clients
+# up to the first Gmail request object, with offline credentials
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from google.oauth2.credentials import Credentials
+from auth import get_authenticated_services
+imported = time.perf_counter()
+gmail_service, sheets_service, drive_service, docs_service = get_authenticated_services(
+    Credentials(token='offline'), lazy=sys.argv[1] == 'lazy')
+gmail_service.users().getProfile(userId='me')
+ready = time.perf_counter()
+print(json.dumps({'imports_ms': (imported - start) * 1000, 'clients_ms': (ready - imported) * 1000,
+                  'total_ms': (ready - start) * 1000}))
+"""
+
+
+def bench_parse(count=2000, repeat=5, body_size=2000):
+    """
+    Measures parse_email_details over a corpus of synthetic message payloads.
+
+    Parameters:
+    - count (int): Messages per shape.
+    - repeat (int): Number of timed passes; the fastest one is reported.
+    - body_size (int): Approximate body length in characters.
+
+    Returns:
+    - Dictionary mapping each shape (and 'all') to microseconds per message
+      and messages per second.
+    """
+    results = {}
+    for shape in MESSAGE_SHAPES + ['all']:
+        corpus = make_corpus(count, None if shape == 'all' else [shape], body_size)
+        # Check that every message yields a body before timing it
+        missing = sum(1 for message in corpus if parse_email_details(message) is None)
+        if missing:
+            raise AssertionError(f"{missing} '{shape}' messages were parsed without a body")
+
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for message in corpus:
+                parse_email_details(message)
+            best = min(best, time.perf_counter() - start)
+        results[shape] = {
+            'us_per_message': round(best / count * 1e6, 2),
+            'messages_per_sec': round(count / best),
+        }
+    return results
+
+
+def bench_e2e(count, latency=0.0, real_quota=False, body_size=2000):
+    """
+    Runs the whole export (main.run) against FakeGoogleServices in a
+    temporary working directory, so checkpoint and folder cache files start empty.
+
+    Parameters:
+    - count (int): Number of messages in the fake mailbox.
+    - latency (float): Simulated seconds per API round trip.
+    - real_quota (bool): Keep the client-side rate limits of concurrency.py;
+      by default they are lifted so the run measures the exporter itself.
+    - body_size (int): Approximate body length in characters.
+
+    Returns:
+    - Dictionary with messages per second, API calls per message by endpoint,
+      p50/p99 latency per pipeline stage and peak RSS.
+    """
+    # Imported here so the parse benchmark does not need the Google client libraries
+    from fake_services import FakeGoogleServices
+    from main import run
+
+    # Per-folder and per-batch progress lines would dominate the output
+    logger.setLevel(logging.WARNING)
+    if not real_quota:
+        for api in API_RATE_LIMITS:
+            set_rate_limit(api, 1e9)
+    fake = FakeGoogleServices(
+        message_count=count, body_size=body_size,
+        latency={api: latency for api in API_RATE_LIMITS})
+    gmail_service, sheet_service, drive_service, doc_service = fake.services()
+
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            start = time.perf_counter()
+            stats = run(gmail_service, sheet_service, drive_service, "2024/11/14", "2024/11/22")
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(previous_dir)
+
+    return {
+        'messages': count,
+        'seconds': round(elapsed, 2),
+        'messages_per_sec': round(count / elapsed, 1),
+        'api_calls_per_message': {method: round(calls / count, 4)
+                                  for method, calls in sorted(fake.call_counts.items())},
+        'round_trips_per_message': round(fake.total_calls() / count, 4),
+        'stage_latency_ms': {name: {'p50': round(stage['latency']['p50'] * 1000, 3),
+                                    'p99': round(stage['latency']['p99'] * 1000, 3)}
+                             for name, stage in (stats or {}).items() if 'latency' in stage},
+        'errors': sum(stage['errors'] for stage in (stats or {}).values()),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_e2e_suite(sizes, latency=0.0, real_quota=False, body_size=2000):
+    # Each size runs in its own process so peak RSS is measured per size
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for count in sizes:
+            output = os.path.join(output_dir, f"{count}.json")
+            command = [sys.executable, os.path.abspath(__file__), "e2e", "--sizes", str(count),
+                       "--latency", str(latency), "--body-size", str(body_size), "--output", output]
+            if real_quota:
+                command.append("--real-quota")
+            subprocess.run(command, check=True)
+            with open(output) as file:
+                results[count] = json.load(file)[str(count)]
+    return results
+
+
+def bench_startup(repeat=5):
+    """
+    Measures cold start with clients built eagerly and lazily, each time in
+    a fresh interpreter. Only the Gmail client is used, as in a run with no new mail.
+
+    Parameters:
+    - repeat (int): Number of runs per mode; the fastest one is reported.
+
+    Returns:
+    - Dictionary mapping 'eager' and 'lazy' to import, client and total milliseconds.
+    """
+    results = {}
+    for mode in ('eager', 'lazy'):
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, mode], check=True,
+                                    capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        best = min(runs, key=lambda run: run['total_ms'])
+        results[mode] = {key: round(value, 1) for key, value in best.items()}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the email exporter")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help="parse_email_details micro-benchmark")
+    parse_parser.add_argument("--count", type=int, default=2000)
+    parse_parser.add_argument("--repeat", type=int, default=5)
+    parse_parser.add_argument("--body-size", type=int, default=2000)
+
+    startup_parser = subparsers.add_parser("startup", help="cold start with eager and lazy API clients")
+    startup_parser.add_argument("--repeat", type=int, default=5)
+
+    e2e_parser = subparsers.add_parser("e2e", help="end-to-end export against fake Google services")
+    e2e_parser.add_argument("--sizes", type=int, nargs="+", default=E2E_SIZES)
+    e2e_parser.add_argument("--latency", type=float, default=0.0)
+    e2e_parser.add_argument("--real-quota", action="store_true")
+    e2e_parser.add_argument("--body-size", type=int, default=2000)
+    # Set by run_e2e_suite: run the sizes in this process and write the results to a file
+    e2e_parser.add_argument("--output", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.command == "parse":
+        results = bench_parse(args.count, args.repeat, args.body_size)
+    elif args.command == "startup":
+        results = bench_startup(args.repeat)
+    elif args.output:
+        results = {count: bench_e2e(count, args.latency, args.real_quota, args.body_size)
+                   for count in args.sizes}
+        with open(args.output, "w") as file:
+            json.dump(results, file)
+        return
+    else:
+        results = run_e2e_suite(args.sizes, args.latency, args.real_quota, args.body_size)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
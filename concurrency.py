@@ -0,0 +1,297 @@
+import contextvars
+import random
+import threading
+import time
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+from googleapiclient.errors import HttpError
+from logger import logger
+from metrics import api_metrics
+
+# Sustained requests per second allowed for each API, tuned to the per-user
+# quotas. Gmail is measured in quota units (250 units per second per user),
+# the others in requests (Sheets and Docs allow 60 writes per minute per user).
+API_RATE_LIMITS = {'gmail': 250, 'drive': 10, 'docs': 1, 'sheets': 1}
+# Gmail quotas are per user, so in a multi-mailbox run every mailbox has
+# its own Gmail limiter; the other APIs write to one shared account
+PER_USER_APIS = ('gmail',)
+# Worker threads of the pipeline's Gmail fetch stage and of the Google
+# sink, whose threads also make its Docs appends and Sheets flushes
+API_POOL_SIZES = {'gmail': 8, 'drive': 8}
+
+# Gmail quota units per method; anything not listed costs one unit/request
+GMAIL_QUOTA_UNITS = {
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.history.list': 2,
+    'gmail.users.getProfile': 1,
+    'gmail.users.watch': 100,
+}
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 6
+BASE_DELAY = 1
+MAX_DELAY = 64
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that allows `rate` tokens per second with bursts
+    of up to `capacity` tokens.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # Returns the seconds spent waiting. Requests larger than the bucket,
+        # e.g. a 100-message Gmail batch, are charged in bucket-sized steps,
+        # so they still pay their full cost
+        waited = 0.0
+        while tokens > 0:
+            step = min(tokens, self.capacity)
+            waited += self._acquire(step)
+            tokens -= step
+        return waited
+
+    def _acquire(self, tokens):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+
+class FairTokenBucket(TokenBucket):
+    """
+    Token bucket shared by several mailboxes that serves the mailboxes
+    waiting for tokens in turn, so while several wait each gets an equal
+    share of the rate, however many requests a large mailbox has queued.
+    """
+
+    def __init__(self, rate, capacity=None):
+        super().__init__(rate, capacity)
+        # Mailboxes with waiting requests, in the order they are served
+        self._turns = deque()
+        self._waiting = Counter()
+        self._served = threading.Condition(self._lock)
+
+    def acquire(self, tokens=1, mailbox=None):
+        # Returns the seconds spent waiting; large requests are charged in steps, as in TokenBucket
+        waited = 0.0
+        while tokens > 0:
+            step = min(tokens, self.capacity)
+            waited += self._acquire_turn(step, mailbox)
+            tokens -= step
+        return waited
+
+    def _acquire_turn(self, tokens, mailbox):
+        start = time.monotonic()
+        with self._served:
+            if not self._waiting[mailbox]:
+                self._turns.append(mailbox)
+            self._waiting[mailbox] += 1
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._turns[0] == mailbox:
+                    if self._tokens >= tokens:
+                        break
+                    self._served.wait((tokens - self._tokens) / self.rate)
+                else:
+                    self._served.wait()
+            self._tokens -= tokens
+            self._waiting[mailbox] -= 1
+            # Move this mailbox's turn to the back, or drop it if nothing else is waiting
+            self._turns.popleft()
+            if self._waiting[mailbox]:
+                self._turns.append(mailbox)
+            else:
+                del self._waiting[mailbox]
+            self._served.notify_all()
+        waited = time.monotonic() - start
+        return waited if waited > 0.001 else 0.0
+
+
+_limiters = {api: TokenBucket(rate) for api, rate in API_RATE_LIMITS.items()}
+
+
+def set_rate_limit(api, rate, capacity=None):
+    # Replace the limiter for an API, e.g. set_rate_limit('drive', 5)
+    _limiters[api] = TokenBucket(rate, capacity)
+
+
+def get_rate_limit(api):
+    return _limiters[api].rate
+
+
+# The MailboxQuota requests are made for; set by the multi-mailbox runner
+# and carried into the pipeline's worker threads
+current_quota = contextvars.ContextVar('current_quota', default=None)
+
+
+class MailboxQuota:
+    """
+    Rate limits and quota usage of one mailbox in a multi-mailbox run.
+
+    Requests for PER_USER_APIS go through the mailbox's own limiter; the
+    others through FairTokenBucket limiters shared by all mailboxes, and
+    through an optional per-mailbox cap from `limits`.
+
+    Parameters:
+    - name (str): The mailbox name.
+    - shared_limiters (dict): FairTokenBucket per shared API.
+    - limits (dict): Requests (or Gmail quota units) per second per API for
+      this mailbox, e.g. {'drive': 3}.
+    """
+
+    def __init__(self, name, shared_limiters, limits=None):
+        self.name = name
+        self.shared_limiters = shared_limiters
+        limits = limits or {}
+        self.limiters = {api: TokenBucket(limits.get(api, get_rate_limit(api))) for api in PER_USER_APIS}
+        self.limiters.update((api, TokenBucket(rate)) for api, rate in limits.items() if api not in PER_USER_APIS)
+        # Tokens taken and seconds spent waiting, per API
+        self.used = Counter()
+        self.throttled = Counter()
+        self._lock = threading.Lock()
+
+    def acquire(self, api, tokens=1):
+        waited = 0.0
+        if api in self.limiters:
+            waited += self.limiters[api].acquire(tokens)
+        if api in self.shared_limiters:
+            waited += self.shared_limiters[api].acquire(tokens, self.name)
+        with self._lock:
+            self.used[api] += tokens
+            self.throttled[api] += waited
+        return waited
+
+    def summary(self):
+        with self._lock:
+            return {'used': dict(self.used),
+                    'throttled_seconds': {api: round(seconds, 3) for api, seconds in self.throttled.items()}}
+
+
+def get_api_name(request):
+    # 'drive.files.create' -> 'drive'
+    method_id = getattr(request, 'methodId', None) or ''
+    return method_id.split('.')[0] or None
+
+
+def get_request_cost(request):
+    return GMAIL_QUOTA_UNITS.get(getattr(request, 'methodId', None), 1)
+
+
+def is_retryable(error):
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    # Google APIs also report rate limits as 403 rateLimitExceeded/userRateLimitExceeded
+    return status == 403 and b'ratelimitexceeded' in (error.content or b'').lower()
+
+
+def get_retry_after(error):
+    # Seconds to wait according to the Retry-After header, if present
+    value = error.resp.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def execute_request(request, http=None, api=None, cost=None, max_retries=MAX_RETRIES):
+    """
+    Executes a googleapiclient request under its API's rate limit, retrying
+    429 and 5xx responses with jittered exponential backoff. Every attempt
+    is recorded in metrics.api_metrics under the request's methodId.
+
+    Inside a multi-mailbox run the current mailbox's quota (see
+    current_quota) is used instead of the process-wide limiters.
+
+    Parameters:
+    - request: An HttpRequest or BatchHttpRequest.
+    - http: The Http object to execute with (required from worker threads).
+    - api: API name ('gmail', 'drive', 'docs', 'sheets'); derived from the
+      request's methodId when not given.
+    - cost: Tokens to take from the API's limiter (defaults to the request's
+      Gmail quota units, or 1).
+    - max_retries: Number of retries before the error is raised.
+
+    Returns:
+    - The response of the request.
+    """
+    api = api or get_api_name(request)
+    quota = current_quota.get()
+    limiter = _limiters.get(api)
+    cost = cost or get_request_cost(request)
+    # Batch requests have no methodId of their own
+    method = getattr(request, 'methodId', None) or f"{api}.batch"
+
+    for attempt in range(max_retries + 1):
+        if quota is not None or limiter is not None:
+            waited = quota.acquire(api, cost) if quota is not None else limiter.acquire(cost)
+            if waited:
+                api_metrics.record_throttle(method, waited)
+        api_metrics.begin(method)
+        start = time.perf_counter()
+        try:
+            response = request.execute(http=http)
+        except HttpError as error:
+            api_metrics.record_call(method, time.perf_counter() - start, error.resp.status)
+            if attempt == max_retries or not is_retryable(error):
+                raise
+            api_metrics.record_retry(method)
+            delay = get_retry_after(error)
+            if delay is None:
+                # Full jitter: a random delay up to the exponential backoff
+                delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+            logger.warning(
+                f"{api} request failed with {error.resp.status}, retrying in {delay:.1f}s "
+                f"(attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+        except Exception as error:
+            # Transport failures such as timeouts or connection resets
+            api_metrics.record_call(method, time.perf_counter() - start, type(error).__name__)
+            raise
+        else:
+            api_metrics.record_call(method, time.perf_counter() - start)
+            return response
+        finally:
+            api_metrics.end()
+
+
+class ApiWorkerPools:
+    """
+    Worker thread counts of the pipeline stages: 'gmail' for fetching and
+    'drive' for the Google sink, which writes the docs and flushes the sheet
+    rows from the same threads. The fetch and write stages are connected by
+    bounded queues, so a throttled Drive slows fetching down instead of
+    letting fetched messages pile up.
+    """
+
+    def __init__(self, pool_sizes=None):
+        self.pool_sizes = dict(API_POOL_SIZES, **(pool_sizes or {}))
+
+    def size(self, api):
+        return self.pool_sizes[api]
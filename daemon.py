@@ -0,0 +1,270 @@
+import argparse
+import base64
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from auth import get_authenticated_services, get_credentials
+from concurrency import ApiWorkerPools, execute_request
+from emails import CHECKPOINT_FILE, get_new_message_ids
+from helper import get_current_date, get_next_day_date
+from journal import JOURNAL_FILE, ExportJournal
+from logger import logger
+from message_cache import MESSAGE_CACHE_FILE, MessageCache
+from metrics import MetricsReporter, api_metrics
+from pipeline import run_email_pipeline
+from sinks import LOCAL_EXPORT_DIR, SINKS, build_sinks
+
+# Long-running exporter that keeps clients, folder IDs and spreadsheet
+# handles warm between syncs, e.g.
+#
+#   python daemon.py --poll-interval 30
+#   python daemon.py --push-port 8080 --topic projects/<project>/topics/<topic>
+
+POLL_INTERVAL = 60
+# Gmail stops sending notifications 7 days after users().watch(); renew daily
+WATCH_RENEW_INTERVAL = 24 * 60 * 60
+# Sinks are flushed after every sync, so this only bounds a very long sync
+ROW_FLUSH_INTERVAL = 5
+
+
+class ExportDaemon:
+    """
+    Exports new mail as it arrives, until stopped.
+
+    A sync runs every `poll_interval` seconds, or as soon as notify() is
+    called, e.g. by a PushReceiver for Gmail's Pub/Sub notifications.
+    Notifications that arrive during a sync are folded into one follow-up
+    sync. Each sync lists only the mail added since the stored history ID, so
+    an idle sync costs a single history().list call.
+
+    Parameters:
+    - gmail_service, sheet_service, drive_service: API service instances.
+    - poll_interval (float): Seconds between syncs without notifications (None to only sync on notify()).
+    - checkpoint_file, journal_file, cache_file: As for main.run.
+    - docs_service, thread_mode, dedupe, outputs, local_dir, local_format, write_docs: As for main.run.
+    """
+
+    def __init__(self, gmail_service, sheet_service, drive_service, poll_interval=POLL_INTERVAL,
+                 checkpoint_file=CHECKPOINT_FILE, journal_file=JOURNAL_FILE, cache_file=MESSAGE_CACHE_FILE,
+                 docs_service=None, thread_mode=False, dedupe=False, outputs=('google',),
+                 local_dir=LOCAL_EXPORT_DIR, local_format='jsonl', write_docs=True):
+        self.gmail_service = gmail_service
+        self.sheet_service = sheet_service
+        self.drive_service = drive_service
+        self.docs_service = docs_service
+        self.thread_mode = thread_mode
+        self.dedupe = dedupe
+        self.poll_interval = poll_interval
+        self.checkpoint_file = checkpoint_file
+        self.syncs = 0
+        self.exported = 0
+
+        # Kept for the daemon's lifetime instead of being rebuilt every run
+        self.pools = ApiWorkerPools()
+        self.journal = ExportJournal(journal_file)
+        self.cache = MessageCache(cache_file) if cache_file else None
+        self.sinks = build_sinks(outputs, sheet_service, drive_service, self.pools, self.journal, docs_service,
+                                 thread_mode, local_dir, local_format, ROW_FLUSH_INTERVAL, write_docs=write_docs)
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._idle = threading.Event()
+
+    def notify(self, history_id=None):
+        # Request a sync now; safe to call from any thread
+        logger.debug(f"Notified of mailbox change (history ID {history_id})")
+        self._wake.set()
+
+    def stop(self):
+        # Finish the current sync, flush buffered rows and return from run()
+        self._stop.set()
+        self._wake.set()
+
+    def run(self):
+        """
+        Syncs until stop() is called, then flushes and closes everything.
+        """
+        logger.info(f"Export daemon started (poll interval: {self.poll_interval}s)")
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                self._idle.clear()
+                try:
+                    self.sync()
+                except Exception as error:
+                    # Keep running; the checkpoint and journal make the next sync retry
+                    logger.exception(f"Sync failed: {error}")
+                self._idle.set()
+                self._wake.wait(self.poll_interval)
+        finally:
+            self.close()
+
+    def sync(self):
+        """
+        Exports the mail added since the last sync.
+
+        Returns:
+        - Number of emails exported.
+        """
+        start = time.monotonic()
+        written = self.sinks[0].written
+        message_ids = get_new_message_ids(
+            self.gmail_service, get_current_date(), get_next_day_date(), self.checkpoint_file)
+        # The pipeline flushes the sinks before returning, so new rows are
+        # visible now rather than at the next size/time threshold
+        stats = run_email_pipeline(
+            self.gmail_service, self.journal.with_unfinished(message_ids), self.sinks, self.pools,
+            journal=self.journal, cache=self.cache, thread_mode=self.thread_mode, dedupe=self.dedupe)
+        if not any(stage['errors'] for stage in stats.values()):
+            message_ids.commit()
+
+        exported = self.sinks[0].written - written
+        self.syncs += 1
+        self.exported += exported
+        if exported:
+            logger.info(f"Exported {exported} new emails in {time.monotonic() - start:.2f}s")
+        return exported
+
+    def wait_idle(self, timeout=None):
+        # Wait until the current sync (if any) has finished; used by tests and benchmarks
+        return self._idle.wait(timeout)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        self.journal.close()
+        if self.cache is not None:
+            self.cache.close()
+        logger.info(f"Export daemon stopped after {self.syncs} syncs, {self.exported} emails exported")
+
+
+def decode_push_notification(body):
+    """
+    Decodes a Pub/Sub push request carrying a Gmail notification.
+
+    Parameters:
+    - body (bytes): The request body, {"message": {"data": <base64 JSON>, ...}, ...}.
+
+    Returns:
+    - The notification, e.g. {"emailAddress": "...", "historyId": 1234}.
+    """
+    envelope = json.loads(body)
+    data = envelope['message']['data']
+    return json.loads(base64.b64decode(data + '=' * (-len(data) % 4)))
+
+
+class PushReceiver:
+    """
+    HTTP endpoint for a Pub/Sub push subscription on the topic Gmail
+    notifies (see watch_mailbox). Every valid notification wakes the daemon.
+
+    Tests can POST a notification built with make_push_notification instead
+    of going through Pub/Sub.
+    """
+
+    def __init__(self, daemon, port=8080, host="0.0.0.0"):
+        self.daemon = daemon
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    notification = decode_push_notification(body)
+                except (KeyError, ValueError) as error:
+                    logger.warning(f"Ignoring malformed push notification: {error}")
+                    # Acknowledge anyway, so Pub/Sub does not redeliver it forever
+                    self.send_response(204)
+                else:
+                    receiver.daemon.notify(notification.get('historyId'))
+                    self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name="push-receiver", daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Listening for push notifications on port {self.port}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_push_notification(history_id, email_address="me"):
+    # The body Pub/Sub would POST for a Gmail notification
+    data = json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode()
+    return json.dumps({'message': {'data': base64.b64encode(data).decode(), 'messageId': str(history_id)},
+                       'subscription': 'local'}).encode()
+
+
+def watch_mailbox(gmail_service, topic_name):
+    """
+    Asks Gmail to publish mailbox changes to a Pub/Sub topic.
+
+    Returns:
+    - The watch response, with the current 'historyId' and the 'expiration' time.
+    """
+    response = execute_request(gmail_service.users().watch(
+        userId="me", body={'topicName': topic_name, 'labelIds': ['INBOX']}, fields="historyId,expiration"))
+    logger.info(f"Watching the mailbox via {topic_name} until {response.get('expiration')}")
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export new mail continuously")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument("--push-port", type=int, help="Port for Pub/Sub push notifications")
+    parser.add_argument("--topic", help="Pub/Sub topic for users().watch(), e.g. projects/p/topics/t")
+    parser.add_argument("--metrics-interval", type=float, default=300)
+    parser.add_argument("--threads", action="store_true", help="Write one doc per thread")
+    parser.add_argument("--dedupe", action="store_true", help="Skip emails already exported under another ID")
+    parser.add_argument("--output", action="append", choices=SINKS, help="Sink to export to (repeatable, default: google)")
+    parser.add_argument("--local-dir", default=LOCAL_EXPORT_DIR)
+    parser.add_argument("--local-format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument("--no-docs", action="store_true", help="Only write sheet rows, without fetching bodies")
+    args = parser.parse_args()
+
+    gmail_service, sheet_service, drive_service, docs_service = get_authenticated_services(get_credentials())
+    daemon = ExportDaemon(gmail_service, sheet_service, drive_service, args.poll_interval,
+                          docs_service=docs_service, thread_mode=args.threads, dedupe=args.dedupe,
+                          outputs=args.output or ('google',), local_dir=args.local_dir,
+                          local_format=args.local_format, write_docs=not args.no_docs)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: daemon.stop())
+
+    receiver = PushReceiver(daemon, args.push_port).start() if args.push_port else None
+    stop_renewing = threading.Event()
+    if args.topic:
+        def renew_watch():
+            while True:
+                try:
+                    watch_mailbox(gmail_service, args.topic)
+                except Exception as error:
+                    logger.exception(f"Could not renew the mailbox watch: {error}")
+                if stop_renewing.wait(WATCH_RENEW_INTERVAL):
+                    return
+        threading.Thread(target=renew_watch, name="watch-renewal", daemon=True).start()
+
+    try:
+        with MetricsReporter(api_metrics, args.metrics_interval):
+            daemon.run()
+    finally:
+        stop_renewing.set()
+        if receiver is not None:
+            receiver.stop()
+
+
+if __name__ == "__main__":
+    main()
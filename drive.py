@@ -1,50 +1,18 @@
-import datetime
-import os
-import json
-from datetime import datetime, timedelta
 from googleapiclient.errors import HttpError
-from spreadsheet import create_spreadsheet_in_folder, write_data_to_spreadsheet
-from helper import get_spreadsheet_file_name
-from logger import logger
+from googleapiclient.http import MediaInMemoryUpload
+from concurrency import execute_request
 
-# # creates folder structure in drive EmailData/year/current_date
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+# Docs larger than this are uploaded to Drive in chunks of this size through
+# a resumable upload (a multiple of 256 KB, as Drive requires)
+DRIVE_UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Characters of text per documents().batchUpdate when appending to a doc
+DOCS_INSERT_CHUNK_SIZE = 100000
 
 
-def create_and_write_doc_in_folder(sheet_service, drive_service, docs_service, folder_dict, spreadsheet_folder_id_dict, doc_title="New Document", content_dict=None):
-    """
-    Creates a new Google Docs document inside a specified folder and writes data into it from a dictionary.
-
-    Parameters:
-    - creds: google.oauth2.credentials.Credentials object.
-    - folder_id: The ID of the folder where the document will be created.
-    - doc_title: The title of the document to be created (default is "New Document").
-    - content_dict: A dictionary where the keys are sections or headings, and the values are the content for those sections.
-
-    Returns:
-    - The ID of the created document.
-    """
-    # gmail_service, service, drive_service, docs_service = get_authenticated_services()
-    if content_dict is None:
-        content_dict = {}  # Default to an empty dictionary if none provided
-
-    try:
-        doc_folder_id_key = content_dict['docs_folder_id_key']
-        folder_id = folder_dict[doc_folder_id_key]
-
-        # Create the Google Docs document in the specified folder
-        file_metadata = {
-            'name': doc_title,
-            'mimeType': 'application/vnd.google-apps.document',
-            'parents': [folder_id]  # Specify the parent folder ID
-        }
-
-        # Create the document using Drive API
-        file = drive_service.files().create(body=file_metadata, fields='id').execute()
-        document_id = file.get('id')
-
-        # Prepare requests to insert content into the document
-        requests = []
-        content = f"""
+def build_doc_content(content_dict):
+    # Text written into each email's Google Doc
+    return f"""
         From: {content_dict['from']}
         To: {content_dict['to']}
         Date: {content_dict['date']}
@@ -54,147 +22,135 @@ def create_and_write_doc_in_folder(sheet_service, drive_service, docs_service, f
         {content_dict['message']}
         """
 
-        requests = [
-            {'insertText': {'location': {'index': 1}, 'text': content}}]
-
-        # to add spreadsheet from here
-        spreadsheet_id = create_spreadsheet_in_folder(
-            drive_service, spreadsheet_folder_id_dict, content_dict, get_spreadsheet_file_name())
-
-        if isinstance(spreadsheet_id, dict):
-            return spreadsheet_id
-        else:
-            link = f'https://docs.google.com/document/d/{document_id}/edit'
-            write_data_to_spreadsheet(
-                sheet_service, spreadsheet_id, content_dict, link, "Sheet1!A1")
-
-            # Execute the batch update to insert all the content
-            docs_service.documents().batchUpdate(documentId=document_id,
-                                                 body={'requests': requests}).execute()
-            return document_id
-
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        return None
-
-
-def create_folder_in_drive(service, path, type):
-    folder_id = None
-    current_year = str(datetime.now().year)
-
-    # Folder dictionary to store folder IDs based on type and date structure
-    folder_dict = {}
-
-    # Step 1: Create or find the 'Email_data@Bdlaz' folder
-    query = "mimeType='application/vnd.google-apps.folder' and name='Email_data@Bdlaz'"
-    try:
-        results = service.files().list(q=query, spaces='drive',
-                                       fields="files(id, name)").execute()
-        folders = results.get('files', [])
-
-        if folders:
-            logger.info(f"Found Email_data@Bdlaz folder")
-            folder_id = folders[0]['id']
-        else:
-            logger.info(f"Creating Email_data@Bdlaz folder")
-            file_metadata = {
-                'name': 'Email_data@Bdlaz',
-                'mimeType': 'application/vnd.google-apps.folder'
-            }
-            folder = service.files().create(body=file_metadata, fields='id').execute()
-            folder_id = folder.get('id')
-            logger.info(f"Created Email_data@Bdlaz folder")
-
-    except Exception as e:
-        raise e
-
-    # Step 2: Create Year Folder (e.g., 2024)
-    year_folder_name = current_year
-    logger.info(f"Starting to create year --> {year_folder_name} folder")
-    year_folder_id = create_subfolder(service, year_folder_name, folder_id)
-    logger.info(f"Finished creating year --> {year_folder_name} folder")
-
-    # Step 3: Loop through each month to create folders for the specified type
-    for month in range(1, 13):
-        month_str = str(month).zfill(2)  # Format month as a 2-digit string
-        month_folder_name = f"{month_str}_{current_year}"
-        logger.info(f"Starting to create --> {month_folder_name} folder")
-        # Create the month folder inside the year folder
-        month_folder_id = create_subfolder(
-            service, month_folder_name, year_folder_id)
-        logger.info(f"Finished creating  --> {month_folder_name} folder")
-        # Only create folders for the specified `type` (either "docs" or "spreadsheet")
-        if type == "docs":
-            logger.info("Starting to create --> docs folder")
-            docs_folder_id = create_subfolder(service, "docs", month_folder_id)
-            logger.info("Finished creating --> docs folder")
-            docs_day_folders = {}
-            start_date = datetime.now().replace(month=month, day=1)
-            end_date = (start_date.replace(month=start_date.month %
-                        # Last day of the month
-                                           12 + 1, day=1) - timedelta(days=1)).day
-            for day in range(1, end_date + 1):
-                day_folder_name = f"{str(day).zfill(2)}_{
-                    month_str}_{current_year}"
-                logger.info(
-                    f"Starting to create --> {day_folder_name} inside docs folder")
-                day_folder_id = create_subfolder(
-                    service, day_folder_name, docs_folder_id)
-                logger.info(
-                    f"Finished creating --> {day_folder_name} inside docs folder")
-                docs_day_folders[f"docs_day_{day}"] = day_folder_id
-
-            # Update the folder_dict with day-wise folder IDs for docs
-            folder_dict.update(docs_day_folders)
-
-        elif type == "spreadsheet":
-            # Only add the month folder ID for spreadsheets without day-wise subfolders
-            logger.info("Starting to create --> spreadsheet folder")
-            spreadsheet_folder_id = create_subfolder(
-                service, "spreadsheet", month_folder_id)
-            logger.info("Finished creating --> spreadsheet folder")
-            folder_dict[f"spreadsheet_{month_str}_{
-                current_year}"] = spreadsheet_folder_id
-
-    return folder_dict
-
-
-# Helper function to create a subfolder
-def create_subfolder(service, folder_name, parent_folder_id):
-    query = f"mimeType='application/vnd.google-apps.folder' and name='{
-        folder_name}'"
-    if parent_folder_id:
-        query += f" and '{parent_folder_id}' in parents"
-
-    try:
-        results = service.files().list(q=query, spaces='drive',
-                                       fields="files(id, name)").execute()
-    except Exception as e:
-        print(f"Error executing query: {query}")
-        raise e
-
-    existing_folders = results.get('files', [])
-
-    if existing_folders:
-        return existing_folders[0]['id']  # Return existing folder ID
-
-    # Create the folder if it doesn't exist
+
+def build_thread_content(content_dicts):
+    # Text for several emails of one thread, written or appended as one block
+    return "\n".join(build_doc_content(content_dict) for content_dict in content_dicts)
+
+
+def get_doc_link(document_id):
+    return f'https://docs.google.com/document/d/{document_id}/edit'
+
+
+def create_doc_with_content(drive_service, folder_id, doc_title, content, http=None):
+    """
+    Creates a Google Doc with its content in a single Drive request.
+
+    The content is uploaded as plain text and converted to a Google Doc by
+    Drive, replacing the separate files().create and documents().batchUpdate
+    calls. Content over DRIVE_UPLOAD_CHUNK_SIZE is sent in chunks of that
+    size, so no single request grows with the size of the doc.
+
+    Parameters:
+    - drive_service: The Drive API service instance.
+    - folder_id: The ID of the folder where the document will be created.
+    - doc_title: The title of the document.
+    - content (str): The text of the document.
+    - http: An authorized Http object to execute the request with (optional).
+      Needed when called from a worker thread, as httplib2 is not thread-safe.
+
+    Returns:
+    - The ID of the created document.
+    """
     file_metadata = {
-        'name': folder_name,
-        'mimeType': 'application/vnd.google-apps.folder',
-        'parents': [parent_folder_id] if parent_folder_id else []
+        'name': doc_title,
+        'mimeType': GOOGLE_DOC_MIME_TYPE,
+        'parents': [folder_id]  # Specify the parent folder ID
     }
-    folder = service.files().create(body=file_metadata, fields='id').execute()
-    return folder.get('id')
-
-# maybe needed afterwards
-# def create_and_move_doc(drive_service, doc_service, folder_id, title, msg_text):
-#     document = {
-#     'title': title
-#     }
-#     response = doc_service.documents().create(body=document).execute()
-#     document_id = response.get('documentId')
-#     print("document_id at create_and_move_doc",document_id)
-#     drive_service.files().update(
-#         fileId=document_id,
-#         addParents=folder_id).execute()
+    data = content.encode('utf-8')
+    media = MediaInMemoryUpload(data, mimetype='text/plain', chunksize=DRIVE_UPLOAD_CHUNK_SIZE,
+                                resumable=len(data) > DRIVE_UPLOAD_CHUNK_SIZE)
+    file = execute_request(drive_service.files().create(
+        body=file_metadata, media_body=media, fields='id'), http)
+    return file.get('id')
+
+
+def append_to_doc(docs_service, document_id, content, http=None):
+    """
+    Appends text to the end of a Google Doc.
+
+    The text is inserted at the end of the body without reading the document
+    first, one request per DOCS_INSERT_CHUNK_SIZE characters. Docs writes
+    have a much lower quota than Drive, so this is only used for emails
+    added to an existing doc.
+
+    Parameters:
+    - docs_service: The Docs API service instance.
+    - document_id: The ID of the document.
+    - content (str): The text to append.
+    - http: An authorized Http object to execute the request with (optional).
+    """
+    for start in range(0, len(content), DOCS_INSERT_CHUNK_SIZE):
+        request = {'insertText': {'endOfSegmentLocation': {},
+                                  'text': content[start:start + DOCS_INSERT_CHUNK_SIZE]}}
+        execute_request(docs_service.documents().batchUpdate(
+            documentId=document_id, body={'requests': [request]}, fields="documentId"), http)
+
+
+class LazyFolderDict:
+    """
+    Dictionary-like view of the docs and spreadsheet folders that resolves
+    each folder the first time an email needs it.
+
+    Keys are the ones produced by parse_email_details:
+    - 'docs_day_DD_MM_YYYY' -> YYYY/MM_YYYY/docs/DD_MM_YYYY
+    - 'spreadsheet_MM_YYYY' -> YYYY/MM_YYYY/spreadsheet
+
+    Folders are created on demand and memoized by the shared FolderCache,
+    so only days that actually have mail get a folder. With a `prefix` of
+    folder names the tree is placed below those folders instead, e.g.
+    prefix=("support",) -> support/YYYY/...
+    """
+
+    def __init__(self, folder_cache, prefix=()):
+        self.folder_cache = folder_cache
+        self.prefix = tuple(prefix)
+
+    def __getitem__(self, key):
+        return self.folder_cache.get_folder_id(*self.prefix, *self._folder_names(key))
+
+    def __contains__(self, key):
+        try:
+            self._folder_names(key)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def with_folder(self, key, write):
+        """
+        Calls `write(folder_id)` with the folder of `key`. If Drive reports the
+        folder missing (404), e.g. because it was deleted or trashed after it
+        was cached, it is evicted from the folder cache, looked up or created
+        again, and `write` is retried once.
+
+        Returns:
+        - Whatever `write` returns.
+        """
+        folder_id = self[key]
+        try:
+            return write(folder_id)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            self.folder_cache.evict(folder_id, *self.prefix, *self._folder_names(key))
+            return write(self[key])
+
+    @staticmethod
+    def _folder_names(key):
+        if key.startswith("docs_day_"):
+            components = key[len("docs_day_"):].split("_")
+            if len(components) == 3 and all(c.isdigit() for c in components):
+                day, month, year = components
+                return year, f"{month}_{year}", "docs", f"{day}_{month}_{year}"
+        elif key.startswith("spreadsheet_"):
+            components = key[len("spreadsheet_"):].split("_")
+            if len(components) == 2 and all(c.isdigit() for c in components):
+                month, year = components
+                return year, f"{month}_{year}", "spreadsheet"
+        raise KeyError(key)
@@ -1,130 +1,469 @@
-from helper import get_text_between_tags
-import base64
-import json
-from datetime import datetime
-from helper import get_next_day_date, get_current_date, join_non_empty_strings, extract_date_time_components
+import time
+from datetime import datetime, timezone
+from googleapiclient.errors import HttpError
+from concurrency import GMAIL_QUOTA_UNITS, execute_request
+from helper import get_next_day_date, get_current_date, join_non_empty_strings, extract_date_time_components, load_json_file, save_json_file, index_headers, decode_body
 from logger import logger
 
 #  proper functions to get and retreive details from email
 
 
-def get_emails_in_date_range(service, start_date=get_current_date(), end_date=get_next_day_date()):
+# Gmail accepts up to 100 calls per batch, but advises that batches larger
+# than 50 are likely to be rate limited
+GMAIL_MAX_BATCH_SIZE = 100
+GMAIL_BATCH_SIZE = 50
+# Largest page size messages().list allows
+GMAIL_LIST_PAGE_SIZE = 500
+CHECKPOINT_FILE = 'last_created_data.json'
+# A scan after an expired history ID starts this many seconds before the
+# last sync, in case a message's date is a little older than its arrival
+SYNC_OVERLAP = 60 * 60
+# Bytes of a message body exported at most. Bodies Gmail stores behind an
+# attachmentId are only downloaded when they are within this size, and
+# longer bodies are cut off, so one huge newsletter cannot exhaust memory
+MAX_BODY_BYTES = 512 * 1024
+# Messages are fetched in full only when their body is exported. Otherwise
+# format='metadata' returns just the headers the sheet row, the folder keys
+# and the doc title are built from, without any body or attachment parts
+MESSAGE_FORMATS = ('full', 'metadata')
+METADATA_HEADERS = ['From', 'To', 'Cc', 'Bcc', 'Date', 'Subject']
+# Parts of the message resource the export reads (no snippet, labelIds, sizeEstimate, ...)
+MESSAGE_FIELDS = {'full': "id,threadId,internalDate,payload",
+                  'metadata': "id,threadId,internalDate,payload/headers"}
+
+
+class MessageIdStream:
+    """
+    Iterable of message IDs to process, together with the checkpoint to
+    record once they have all been processed.
+
+    Call commit() only after every ID has been handled, so an interrupted
+    run never advances the checkpoint past unprocessed mail.
     """
-    Retrieves emails within a specified date range and extracts their details.
+
+    def __init__(self, message_ids, json_data, checkpoint_file, updates, description):
+        self.message_ids = message_ids
+        self.json_data = json_data
+        self.checkpoint_file = checkpoint_file
+        # Checkpoint values to save; may be filled in while listing
+        self.updates = updates
+        self.description = description
+
+    def __iter__(self):
+        logger.info(f"Started listing email IDs {self.description}")
+        yield from self.message_ids
+        logger.info(f"Finished listing email IDs {self.description}")
+
+    def commit(self):
+        self.json_data.update(self.updates)
+        # Write the updated data back to the JSON file
+        save_json_file(self.checkpoint_file, self.json_data)
+
+
+def get_message_ids_in_date_range(service, start_date, end_date, checkpoint_file=CHECKPOINT_FILE):
+    """
+    Lists the IDs of emails within a date range that has not been processed yet.
 
     Parameters:
     - service: The Gmail API service instance.
     - start_date (str): Start date in 'YYYY/MM/DD' format.
     - end_date (str): End date in 'YYYY/MM/DD' format.
+    - checkpoint_file (str): JSON file holding 'last_epoch' and 'history_id'.
+
+    Returns:
+    - A MessageIdStream, or a dictionary with an 'info' key if the range was
+      already processed.
+    """
+    json_data = load_json_file(checkpoint_file)
+    end_epoch = int(datetime.strptime(end_date, "%Y/%m/%d").timestamp())
+    if json_data.get('last_epoch', float('-inf')) >= end_epoch:
+        return {'info': f'Data till {end_date} already exists'}
+    return _date_range_stream(service, start_date, end_date, json_data, checkpoint_file)
+
+
+def get_new_message_ids(service, start_date=get_current_date(), end_date=get_next_day_date(), checkpoint_file=CHECKPOINT_FILE):
+    """
+    Lists the IDs of emails added to the mailbox since the previous run.
+
+    When the checkpoint holds a 'history_id', only messages added after it are
+    listed through users().history().list, so the cost scales with new mail
+    rather than with the window size. Without a stored history ID this
+    falls back to a full scan of the date range. When Gmail reports that the
+    history ID has expired, everything since the last successful sync
+    ('last_sync_epoch') is scanned instead. Both scans also record the
+    mailbox's current history ID.
+
+    Parameters:
+    - service: The Gmail API service instance.
+    - start_date (str): Start date of the fallback window in 'YYYY/MM/DD' format.
+    - end_date (str): End date of the fallback window in 'YYYY/MM/DD' format.
+    - checkpoint_file (str): JSON file holding 'last_epoch', 'history_id'
+      and 'last_sync_epoch'.
 
     Returns:
-    - List of dictionaries, each containing details of an email.
+    - A MessageIdStream.
     """
+    json_data = load_json_file(checkpoint_file)
+    history_id = json_data.get('history_id')
+    # Saved on commit, once everything listed from here on has been exported
+    sync_epoch = int(time.time())
+
+    if history_id:
+        try:
+            # Fetch the first page eagerly so an expired history ID is
+            # detected here rather than halfway through the caller's loop
+            first_page = _list_history_page(service, history_id)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            logger.warning(
+                f"History ID {history_id} has expired, falling back to a full scan")
+        else:
+            updates = {'history_id': history_id, 'last_sync_epoch': sync_epoch}
+            message_ids = list_added_message_ids(
+                service, history_id, first_page, updates)
+            return MessageIdStream(message_ids, json_data, checkpoint_file, updates,
+                                   f"added since history ID {history_id}")
+
+    # Record the history ID before scanning so mail arriving during the
+    # scan is picked up by the next incremental run
+    profile = execute_request(
+        service.users().getProfile(userId="me", fields="historyId"))
+    last_sync_epoch = json_data.get('last_sync_epoch')
+    if last_sync_epoch:
+        # Mail added since the last sync may lie outside the caller's window
+        since = last_sync_epoch - SYNC_OVERLAP
+        stream = MessageIdStream(list_message_ids(service, f"after:{since}"), json_data, checkpoint_file,
+                                 {}, f"since {datetime.fromtimestamp(since):%Y/%m/%d %H:%M:%S}")
+    else:
+        stream = _date_range_stream(service, start_date, end_date, json_data, checkpoint_file)
+    stream.updates.update({'history_id': profile['historyId'], 'last_sync_epoch': sync_epoch})
+    return stream
+
+
+def _date_range_stream(service, start_date, end_date, json_data, checkpoint_file):
     # Convert dates to Gmail's query format (epoch timestamps in seconds)
     start_epoch = int(datetime.strptime(start_date, "%Y/%m/%d").timestamp())
     end_epoch = int(datetime.strptime(end_date, "%Y/%m/%d").timestamp())
-    with open('last_created_data.json') as file:
-        json_data = json.load(file)
-
-    if not json_data or json_data.get('last_epoch', float('-inf')) < end_epoch:
-        # Construct the query string for the date range
-        query = f"after:{start_epoch} before:{end_epoch}"
-
-        logger.info(f"Started fetching email data for {
-                    start_date} to {end_date} ")
-        # Get list of emails in the specified date range
-        results = service.users().messages().list(userId="me", q=query).execute()
-        logger.info(f"Finished fetching email data for {
-                    start_date} to {end_date} ")
-        email_details_list = []
-        logger.info(f"Starting to process fetched email data")
-        # If messages are found
-        if 'messages' in results:
-            message_ids = results['messages']
-
-            # Retrieve details for each email by calling extract_email_details
-            for msg in message_ids:
-                email_data = extract_email_details(service, msg['id'])
-                email_details_list.append(email_data)
-
-        json_data['last_epoch'] = end_epoch
-        # Write the updated data back to the JSON file
-        with open('last_created_data.json', 'w') as file:
-            json.dump(json_data, file, indent=4)
-        return email_details_list
-    else:
-        return {'info': f'Data till {end_date} already exists'}
+    # Construct the query string for the date range
+    query = f"after:{start_epoch} before:{end_epoch}"
+    return MessageIdStream(list_message_ids(service, query), json_data, checkpoint_file,
+                           {'last_epoch': end_epoch}, f"for {start_date} to {end_date}")
+
+
+def _list_history_page(service, history_id, page_token=None):
+    return execute_request(service.users().history().list(
+        userId="me", startHistoryId=history_id, historyTypes="messageAdded",
+        maxResults=GMAIL_LIST_PAGE_SIZE, pageToken=page_token,
+        fields="history(messagesAdded(message(id,labelIds))),nextPageToken,historyId"))
+
+
+def list_added_message_ids(service, history_id, first_page=None, latest=None):
+    """
+    Lists the IDs of emails added to the mailbox after a given history ID.
+
+    Parameters:
+    - service: The Gmail API service instance.
+    - history_id (str): History ID recorded by the previous run.
+    - first_page (dict): An already fetched first page of history, if any.
+    - latest (dict): If given, its 'history_id' key is updated with the
+      mailbox's current history ID once the last page has been read.
 
+    Returns:
+    - Generator of message IDs, skipping spam and trash like a search query would.
+    """
+    page = first_page or _list_history_page(service, history_id)
+    seen = set()
+    while True:
+        for record in page.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                labels = message.get('labelIds', [])
+                if message['id'] in seen or 'SPAM' in labels or 'TRASH' in labels:
+                    continue
+                seen.add(message['id'])
+                yield message['id']
+
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            break
+        page = _list_history_page(service, history_id, page_token)
+
+    if latest is not None:
+        latest['history_id'] = page['historyId']
 
-def extract_email_details(service, message_id):
+
+def list_message_ids(service, query, page_size=GMAIL_LIST_PAGE_SIZE):
     """
-    Extracts specific details (from, to, date, subject, message) from an email.
+    Lists the IDs of all emails matching a Gmail search query.
+
+    Every result page is followed via nextPageToken, and IDs are yielded as
+    each page arrives so that fetching can start before listing finishes.
 
     Parameters:
     - service: The Gmail API service instance.
-    - message_id (str): The ID of the email message to retrieve.
+    - query (str): Gmail search query, e.g. "after:<epoch> before:<epoch>".
+    - page_size (int): Number of IDs requested per page (max 500).
+
+    Returns:
+    - Generator of message IDs.
+    """
+    page_token = None
+    while True:
+        results = execute_request(service.users().messages().list(
+            userId="me", q=query, maxResults=page_size, pageToken=page_token,
+            fields="messages/id,nextPageToken"))
+        for msg in results.get('messages', []):
+            yield msg['id']
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+def get_message_request(service, message_id, message_format='full'):
+    # messages().get for one of MESSAGE_FORMATS, asking only for the fields the export reads
+    if message_format == 'metadata':
+        return service.users().messages().get(
+            userId="me", id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS,
+            fields=MESSAGE_FIELDS['metadata'])
+    return service.users().messages().get(
+        userId="me", id=message_id, format='full', fields=MESSAGE_FIELDS['full'])
+
+
+def fetch_message(service, message_id, http=None, cache=None, message_format='full'):
+    # Fetch the Gmail message resource for one email, from the cache if possible.
+    # A cached full message also serves a metadata fetch; metadata is not cached
+    if cache is not None:
+        email_data = cache.get(message_id)
+        if email_data is not None:
+            return email_data
+    email_data = execute_request(get_message_request(service, message_id, message_format), http)
+    if cache is not None and message_format == 'full':
+        cache.put(email_data)
+    return email_data
+
+
+def fetch_messages_batch(service, message_ids, batch_size=GMAIL_BATCH_SIZE, http=None, cache=None,
+                         max_body_bytes=MAX_BODY_BYTES, message_format='full'):
+    """
+    Fetches Gmail message resources using batch HTTP requests.
+
+    Each batch bundles up to `batch_size` messages().get calls into a single
+    round trip. Messages that fail inside a batch are retried one by one.
+    With a cache, only the messages missing from it are fetched. Bodies
+    stored behind an attachmentId are then downloaded if they are within
+    `max_body_bytes` (see fetch_body_attachment), and the fetched messages
+    are added to the cache with those bodies.
+
+    With message_format='metadata' only the headers are fetched (see
+    METADATA_HEADERS), and such messages are not added to the cache.
+
+    Parameters:
+    - service: The Gmail API service instance.
+    - message_ids (list): IDs of the email messages to retrieve.
+    - batch_size (int): Number of messages per batch request (capped at 100).
+    - http: The Http object to execute with, when called from a worker thread.
+    - cache: A MessageCache to read messages from before fetching them, or None.
+    - max_body_bytes (int): Size cap for body downloads (see MAX_BODY_BYTES).
+    - message_format (str): 'full' or 'metadata'.
+
+    Returns:
+    - List of message resources in the same order as `message_ids`, without
+      the messages that no longer exist (deleted since they were listed).
+    """
+    batch_size = max(1, min(batch_size, GMAIL_MAX_BATCH_SIZE))
+    cached = cache.get_many(message_ids) if cache is not None else {}
+    missing = [message_id for message_id in message_ids if message_id not in cached]
+    fetched = {}
+
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        responses = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            else:
+                logger.warning(
+                    f"Batch fetch failed for message {request_id}: {exception}")
+
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in chunk:
+            batch.add(get_message_request(service, message_id, message_format), request_id=message_id)
+        # Every call in the batch counts against the Gmail quota
+        execute_request(batch, http, api='gmail',
+                        cost=GMAIL_QUOTA_UNITS['gmail.users.messages.get'] * len(chunk))
+
+        for message_id in chunk:
+            if message_id not in responses:
+                # Retry the failed message on its own
+                try:
+                    responses[message_id] = fetch_message(service, message_id, http, message_format=message_format)
+                except HttpError as error:
+                    if error.resp.status != 404:
+                        raise
+                    # Deleted since it was listed, e.g. an ID from history().list
+                    logger.info(f"Message {message_id} no longer exists, skipping it")
+        fetched.update(responses)
+
+    messages = [cached[message_id] if message_id in cached else fetched[message_id]
+                for message_id in message_ids if message_id in cached or message_id in fetched]
+    if message_format == 'full':
+        downloaded = {email_data['id'] for email_data in messages
+                      if fetch_body_attachment(service, email_data, http, max_body_bytes)}
+        if cache is not None:
+            # Cached with their downloaded bodies, so a cache hit needs no attachments().get
+            cache.put_many(email_data for email_data in messages
+                           if email_data['id'] in fetched or email_data['id'] in downloaded)
+    return messages
+
+
+def fetch_body_attachment(service, email_data, http=None, max_bytes=MAX_BODY_BYTES):
+    """
+    Downloads the body of a message whose body part Gmail stores behind an
+    attachmentId, as it does for large bodies, and puts it in the part's
+    'data' like an inline body. Bodies over `max_bytes` are left out; the
+    parsed message then says so instead of the text (see read_body_part).
+
+    fetch_messages_batch caches messages with the downloaded body, so it is
+    only downloaded once.
+
+    Returns:
+    - True if the body was downloaded.
+    """
+    body_part = find_body_part(email_data.get('payload', {}))
+    if body_part is None:
+        return False
+    body = body_part['body']
+    if body.get('data') or not body.get('attachmentId') or body.get('size', 0) > max_bytes:
+        return False
+    attachment = execute_request(service.users().messages().attachments().get(
+        userId="me", messageId=email_data['id'], id=body['attachmentId'], fields="data"), http)
+    body['data'] = attachment.get('data', '')
+    return True
+
+
+def parse_email_details(email_data, max_body_bytes=MAX_BODY_BYTES, with_body=True):
+    """
+    Extracts specific details (from, to, date, subject, message) from a fetched email.
+
+    Parameters:
+    - email_data (dict): A Gmail message resource fetched with format='full'.
+    - max_body_bytes (int): Bytes of the body decoded at most (see read_body_part).
+    - with_body (bool): Extract the body; False for a message fetched with
+      format='metadata', whose details then have no 'message'.
 
     Returns:
     - A dictionary containing the email's from, to, date, subject, and message body.
     """
-    email_data = service.users().messages().get(
-        userId="me", id=message_id, format='full').execute()
-    headers = email_data['payload']['headers']
+    payload = email_data['payload']
+    # Index the headers once instead of scanning the list for every field
+    headers = index_headers(payload.get('headers', []))
 
     # Extract the required headers
     email_info = {
-        'from': join_non_empty_strings(next((header['value'] for header in headers if header['name'] == 'From')), ""),
-        'date': next((header['value'] for header in headers if header['name'] == 'Date'), ""),
-        'subject': next((header['value'] for header in headers if header['name'] == 'Subject'), "")
+        'id': email_data.get('id'),
+        'thread_id': email_data.get('threadId'),
+        'from': join_non_empty_strings(headers.get('from', "")),
+        'subject': headers.get('subject', "")
     }
-    to = next((header['value']
-              for header in headers if header['name'] == 'To'), "")
-    cc = next((header['value']
-              for header in headers if header['name'] == 'Cc'), "")
-    bcc = next((header['value']
-               for header in headers if header['name'] == 'Bcc'), "")
-    email_info['to'] = join_non_empty_strings(to, cc, bcc)
-
-    date_string = next(
-        (header['value'] for header in headers if header['name'] == 'Date'), "")
+    email_info['to'] = join_non_empty_strings(
+        headers.get('to', ""), headers.get('cc', ""), headers.get('bcc', ""))
+
+    date_string = headers.get('date', "")
     (day, month, year, hour, minute, second) = extract_date_time_components(date_string)
+    if not day.isdigit():
+        # Unparseable Date header: use when Gmail received the email, so it still gets a folder
+        received = datetime.fromtimestamp(int(email_data.get('internalDate') or 0) / 1000, timezone.utc)
+        (day, month, year, hour, minute, second) = (str(value) for value in (
+            received.day, received.month, received.year, received.hour, received.minute, received.second))
     email_info['date'] = day+"/"+month+"/"+year+"; "+hour+":"+minute+":"+second
-    email_info['docs_folder_id_key'] = "docs_day_"+day
-    email_info['sheet_folder_id_key'] = "spreadsheet_"+month+"_"+year
+    # Keys carry the full date so the same day number in different months
+    # or years resolves to different folders
+    email_info['docs_folder_id_key'] = "docs_day_" + \
+        day.zfill(2)+"_"+month.zfill(2)+"_"+year
+    email_info['sheet_folder_id_key'] = "spreadsheet_"+month.zfill(2)+"_"+year
+    if not with_body:
+        return email_info
 
-    # Get the full email message (plain text or HTML)
-    parts = email_data['payload'].get('parts', [])
+    # Get the full email message, preferring plain text over HTML
+    body_part = find_body_part(payload)
     message_body = ""
-
-    # Check for plain text and HTML parts
-    for part in parts:
-        if part['mimeType'] == 'text/plain':
-            # Decode and extract plain text message
-            message_body = base64.urlsafe_b64decode(
-                part['body'].get('data', '')).decode('utf-8')
-            break  # Stop after the first plain text part is found
-
-        elif part['mimeType'] == 'text/html':
-            # Decode and extract HTML message
-            message_body = base64.urlsafe_b64decode(
-                part['body'].get('data', '')).decode('utf-8')
-            break  # Stop after the first HTML part is found
-
-        # Check for nested parts if there are any
-        elif 'parts' in part:
-            nested_parts = part['parts']
-            for nested_part in nested_parts:
-                if nested_part['mimeType'] == 'text/plain':
-                    message_body = base64.urlsafe_b64decode(
-                        nested_part['body'].get('data', '')).decode('utf-8')
-                    break
-                elif nested_part['mimeType'] == 'text/html':
-                    message_body = base64.urlsafe_b64decode(
-                        nested_part['body'].get('data', '')).decode('utf-8')
-                    break
+    if body_part is not None:
+        message_body = read_body_part(body_part, max_body_bytes)
 
     # If no plain text or HTML was found, you may want to check for other mime types
     if not message_body:
         return None
     email_info['message'] = message_body
     return email_info
+
+
+def find_body_part(payload):
+    """
+    Finds the part holding the message body, however deeply it is nested.
+
+    The first text/plain part in depth-first order is preferred; otherwise the
+    first text/html part is used. Attachments (parts with a filename) are skipped.
+
+    Parameters:
+    - payload (dict): The 'payload' of a Gmail message resource.
+
+    Returns:
+    - The body part, or None if the message has no text part.
+    """
+    html_part = None
+    for part in walk_parts(payload):
+        if part.get('filename'):
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain':
+            return part
+        if mime_type == 'text/html' and html_part is None:
+            html_part = part
+    return html_part
+
+
+def read_body_part(part, max_bytes=MAX_BODY_BYTES):
+    """
+    Decodes the text of a body part, up to `max_bytes` of it.
+
+    Only the base64 data needed for `max_bytes` is decoded, so the memory
+    used does not grow with the size of the body. A note replaces the text
+    that was cut off, or the whole body if it was too large to download.
+
+    Returns:
+    - The text of the part.
+    """
+    body = part['body']
+    data = body.get('data', '')
+    if not data:
+        if body.get('attachmentId'):
+            return f"[Message body of {body.get('size', 0)} bytes not exported: over the {max_bytes} byte limit]"
+        return ""
+    # Every 4 base64 characters hold 3 bytes
+    limit = -(-max_bytes // 3) * 4
+    text = decode_body(data[:limit], get_part_charset(part))
+    if len(data) > limit:
+        size = body.get('size') or len(data) * 3 // 4
+        text += f"\n[Message truncated: {max_bytes} of {size} bytes exported]"
+    return text
+
+
+def walk_parts(part):
+    # Yield a MIME part and all of its nested parts, depth first
+    yield part
+    for child in part.get('parts', ()):
+        yield from walk_parts(child)
+
+
+def get_part_charset(part):
+    # Charset from the part's Content-Type header, defaulting to UTF-8
+    for header in part.get('headers', ()):
+        if header['name'].lower() == 'content-type':
+            for param in header['value'].split(';')[1:]:
+                name, _, value = param.strip().partition('=')
+                if name.lower() == 'charset':
+                    return value.strip('"\' ') or "utf-8"
+    return "utf-8"
@@ -0,0 +1,528 @@
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import httplib2
+from googleapiclient.errors import HttpError
+from metrics import Histogram, api_metrics
+from synthetic_mail import make_message
+
+# In-process stand-ins for the Gmail, Sheets, Drive and Docs services returned
+# by auth.get_authenticated_services, for benchmarks and offline runs.
+#
+#   fake = FakeGoogleServices(message_count=1000, latency={'gmail': 0.05})
+#   gmail_service, sheets_service, drive_service, docs_service = fake.services()
+#
+# Every executed request is recorded in fake.call_counts, fake.call_latency,
+# fake.error_counts and fake.bytes_sent / fake.bytes_returned.
+
+
+class FakeRequest:
+    """
+    Stand-in for googleapiclient.http.HttpRequest. Responses are pruned to
+    the request's `fields` mask, if it has one.
+    """
+
+    def __init__(self, fake, method_id, handler, body_size=0, fields=None):
+        self.fake = fake
+        self.methodId = method_id
+        self.handler = handler if not fields else lambda: apply_fields(handler(), fields)
+        self.body_size = body_size
+
+    def execute(self, http=None, num_retries=0):
+        return self.fake._execute(self.methodId, self.handler, self.body_size)
+
+
+class FakeBatchRequest:
+    """
+    Stand-in for googleapiclient.http.BatchHttpRequest.
+    """
+
+    def __init__(self, fake, callback=None):
+        self.fake = fake
+        self.callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        request_id = request_id or str(len(self._requests))
+        self._requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        def handler():
+            results = []
+            for request_id, request, callback in self._requests:
+                # Inner calls are accounted for but not delayed individually
+                try:
+                    self.fake._check_faults(request.methodId)
+                    response, exception = request.handler(), None
+                except HttpError as error:
+                    response, exception = None, error
+                    with self.fake._lock:
+                        self.fake.error_counts[f"batch:{request.methodId}"] += 1
+                self.fake._record(request.methodId, 0.0, 0, response, in_batch=True)
+                results.append((callback, request_id, response, exception))
+            return results
+
+        for callback, request_id, response, exception in self.fake._execute('gmail.batch', handler):
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _Resource:
+    # Attribute access builds the resource chain, e.g. users().messages().get(...)
+    def __init__(self, methods):
+        self._methods = methods
+
+    def __getattr__(self, name):
+        try:
+            return self._methods[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _parse_fields(tokens):
+    # Tokens of "a,b/c,d(e,f)" -> {'a': None, 'b': {'c': None}, 'd': {'e': None, 'f': None}}
+    tree = {}
+    while tokens and tokens[0] != ')':
+        _parse_field(tokens, tree)
+        if tokens and tokens[0] == ',':
+            tokens.pop(0)
+    return tree
+
+
+def _parse_field(tokens, tree):
+    name = tokens.pop(0)
+    if tokens and tokens[0] == '/':
+        tokens.pop(0)
+        subtree = tree.get(name) or {}
+        _parse_field(tokens, subtree)
+        tree[name] = subtree
+    elif tokens and tokens[0] == '(':
+        tokens.pop(0)
+        subtree = tree.get(name) or {}
+        subtree.update(_parse_fields(tokens))
+        tokens.pop(0)
+        tree[name] = subtree
+    else:
+        tree[name] = None
+
+
+def apply_fields(response, fields):
+    """
+    Prunes a response to a `fields` mask, e.g. "id,payload/headers" or
+    "files(id,name),nextPageToken", the way the real APIs do.
+    """
+    if not fields or not isinstance(response, dict):
+        return response
+    return _prune(response, _parse_fields(re.findall(r"[^,/()\s]+|[,/()]", fields)))
+
+
+def _prune(value, tree):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [_prune(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: _prune(value[name], subtree) for name, subtree in tree.items() if name in value}
+
+
+def _http_error(status, message, retry_after=None):
+    headers = {'status': str(status)}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    content = json.dumps({'error': {'code': status, 'message': message}}).encode()
+    return HttpError(httplib2.Response(headers), content)
+
+
+class FakeGoogleServices:
+    """
+    A fake mailbox plus Drive, Sheets and Docs storage, served in-process.
+
+    Parameters:
+    - message_count (int): Number of messages in the mailbox.
+    - start_date, end_date (str): 'YYYY/MM/DD' range the messages are spread over.
+    - latency (dict): Seconds of simulated latency per API ('gmail', 'drive', ...).
+    - error_rate (dict): Probability per API that a call fails with a 500.
+    - quota (dict): Calls per second allowed per API; calls over it get a 429.
+    - body_size (int): Approximate body length of each message.
+    - thread_size (int): Number of consecutive messages sharing a thread.
+    - shapes (list): Message shapes to cycle through (see synthetic_mail; random if None).
+    - seed: Seed for error injection.
+    """
+
+    def __init__(self, message_count=100, start_date="2024/11/14", end_date="2024/11/22",
+                 latency=None, error_rate=None, quota=None, body_size=2000, thread_size=1, shapes=None, seed=0):
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.quota = quota or {}
+        self.body_size = body_size
+        self.thread_size = thread_size
+        self.shapes = shapes
+
+        self.start = datetime.strptime(start_date, "%Y/%m/%d").replace(tzinfo=timezone.utc)
+        self.end = datetime.strptime(end_date, "%Y/%m/%d").replace(tzinfo=timezone.utc)
+        self.message_count = message_count
+        # Messages below this index are spread evenly over the date range;
+        # later ones come from add_messages and are dated when delivered
+        self.window_count = message_count
+        self._delivered_at = {}
+        self.history_id = 1000
+        # History records as (history ID, message ID) for messages added after creation
+        self.history = []
+        # Deleted message IDs; history keeps their messagesAdded records, as Gmail's does
+        self.deleted = set()
+
+        self.files = {}
+        self.sheet_values = {}
+        self.call_counts = Counter()
+        self.call_latency = {}
+        self.bytes_sent = Counter()
+        self.bytes_returned = Counter()
+        self.error_counts = Counter()
+
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._quota_windows = {}
+        self._lock = threading.Lock()
+
+    # -- bookkeeping -------------------------------------------------------
+
+    def services(self):
+        """
+        Returns:
+        - (gmail_service, sheets_service, drive_service, docs_service), like
+          auth.get_authenticated_services.
+        """
+        return self._gmail(), self._sheets(), self._drive(), self._docs()
+
+    def total_calls(self):
+        # HTTP round trips; calls made inside a batch are not separate round trips
+        return sum(count for method, count in self.call_counts.items()
+                   if not method.startswith('batch:'))
+
+    def _record(self, method_id, duration, body_size, response, in_batch=False):
+        # Calls made inside a batch are counted under a 'batch:' prefix
+        key = f"batch:{method_id}" if in_batch else method_id
+        response_size = len(json.dumps(response)) if isinstance(response, dict) else 0
+        with self._lock:
+            self.call_counts[key] += 1
+            self.bytes_sent[key] += body_size
+            self.bytes_returned[key] += response_size
+            if not in_batch:
+                self.call_latency.setdefault(key, Histogram()).record(duration)
+        # Stand in for the transport hooks in transport.py
+        api_metrics.record_transfer(body_size, response_size)
+
+    def _check_faults(self, method_id):
+        api = method_id.split('.')[0]
+        with self._lock:
+            if self._random.random() < self.error_rate.get(api, 0):
+                raise _http_error(500, "Injected backend error")
+            limit = self.quota.get(api)
+            if limit:
+                second = int(time.monotonic())
+                window_start, used = self._quota_windows.get(api, (second, 0))
+                if window_start != second:
+                    window_start, used = second, 0
+                if used >= limit:
+                    raise _http_error(429, "Quota exceeded", retry_after=1)
+                self._quota_windows[api] = (window_start, used + 1)
+
+    def _execute(self, method_id, handler, body_size=0):
+        api = method_id.split('.')[0]
+        start = time.perf_counter()
+        delay = self.latency.get(api, 0)
+        if delay:
+            time.sleep(delay)
+        try:
+            self._check_faults(method_id)
+            response = handler()
+        except HttpError:
+            self._record(method_id, time.perf_counter() - start, body_size, None)
+            with self._lock:
+                self.error_counts[method_id] += 1
+            raise
+        self._record(method_id, time.perf_counter() - start, body_size, response)
+        return response
+
+    def _new_id(self, prefix):
+        return f"{prefix}{next(self._ids):08d}"
+
+    # -- Gmail -------------------------------------------------------------
+
+    def _step(self):
+        # Seconds between consecutive messages of the date range
+        return (self.end - self.start).total_seconds() / max(1, self.window_count)
+
+    def _message_date(self, index):
+        if index in self._delivered_at:
+            return self._delivered_at[index]
+        return self.start + timedelta(seconds=(index + 0.5) * self._step())
+
+    def _index_at(self, epoch):
+        # Number of range messages dated before `epoch`
+        position = math.ceil((epoch - self.start.timestamp()) / self._step() - 0.5)
+        return min(self.window_count, max(0, position))
+
+    def _message_index(self, message_id):
+        if not message_id.startswith('msg') or not message_id[3:].isdigit():
+            raise _http_error(404, "Requested entity was not found.")
+        index = int(message_id[3:])
+        if index >= self.message_count or message_id in self.deleted:
+            raise _http_error(404, "Requested entity was not found.")
+        return index
+
+    def add_messages(self, count):
+        """
+        Delivers `count` new messages dated now and records them in the history.
+
+        Returns:
+        - List of the new message IDs.
+        """
+        with self._lock:
+            first = self.message_count
+            self.message_count += count
+            message_ids = []
+            for index in range(first, first + count):
+                self.history_id += 1
+                message_ids.append(f'msg{index:08d}')
+                self.history.append((self.history_id, message_ids[-1]))
+            now = datetime.now(timezone.utc)
+            for index in range(first, first + count):
+                self._delivered_at[index] = now
+        return message_ids
+
+    def delete_messages(self, message_ids):
+        # Later messages().get calls for these return 404
+        with self._lock:
+            self.deleted.update(message_ids)
+
+    def get_message(self, message_id):
+        index = self._message_index(message_id)
+        shape = self.shapes[index % len(self.shapes)] if self.shapes else None
+        return make_message(index, shape, body_size=self.body_size, date=self._message_date(index),
+                            thread_size=self.thread_size)
+
+    def _list_messages(self, userId="me", q="", maxResults=100, pageToken=None, fields=None, **kwargs):
+        after = re.search(r"after:(\d+)", q or "")
+        before = re.search(r"before:(\d+)", q or "")
+        first = self._index_at(int(after.group(1))) if after else 0
+        last = self._index_at(int(before.group(1))) if before else self.window_count
+
+        def handler():
+            # Range messages, then those delivered by add_messages
+            indexes = list(range(first, last)) + [
+                index for index, date in sorted(self._delivered_at.items())
+                if (not after or date.timestamp() > int(after.group(1)))
+                and (not before or date.timestamp() < int(before.group(1)))]
+            start = int(pageToken or 0)
+            stop = min(len(indexes), start + maxResults)
+            response = {'messages': [{'id': f'msg{index:08d}', 'threadId': f'thr{index:08d}'}
+                                     for index in indexes[start:stop] if f'msg{index:08d}' not in self.deleted],
+                        'resultSizeEstimate': len(indexes)}
+            if stop < len(indexes):
+                response['nextPageToken'] = str(stop)
+            if not response['messages']:
+                del response['messages']
+            return response
+        return FakeRequest(self, 'gmail.users.messages.list', handler, fields=fields)
+
+    def _get_message(self, userId="me", id=None, format='full', metadataHeaders=None, fields=None, **kwargs):
+        def handler():
+            message = self.get_message(id)
+            if format == 'metadata':
+                payload = message['payload']
+                wanted = {name.lower() for name in metadataHeaders or ()}
+                headers = [header for header in payload['headers']
+                           if not wanted or header['name'].lower() in wanted]
+                message['payload'] = {'mimeType': payload['mimeType'], 'headers': headers}
+            elif format == 'minimal':
+                del message['payload']
+            else:
+                # Attachment data is only returned by attachments().get
+                stack = [message['payload']]
+                while stack:
+                    part = stack.pop()
+                    part['body'].pop('_data', None)
+                    stack.extend(part.get('parts', ()))
+            return message
+        return FakeRequest(self, 'gmail.users.messages.get', handler, fields=fields)
+
+    def _get_attachment(self, userId="me", messageId=None, id=None, fields=None, **kwargs):
+        def handler():
+            message = self.get_message(messageId)
+            stack = [message['payload']]
+            while stack:
+                part = stack.pop()
+                if part['body'].get('attachmentId') == id:
+                    return {'size': part['body'].get('size', 0),
+                            'data': part['body'].get('_data', 'AAAA')}
+                stack.extend(part.get('parts', ()))
+            raise _http_error(404, "Attachment not found")
+        return FakeRequest(self, 'gmail.users.messages.attachments.get', handler, fields=fields)
+
+    def _list_history(self, userId="me", startHistoryId=None, historyTypes=None, maxResults=100,
+                      pageToken=None, fields=None, **kwargs):
+        def handler():
+            start_history_id = int(startHistoryId)
+            if start_history_id < 1000:
+                raise _http_error(404, "Requested entity was not found.")
+            records = [record for record in self.history if record[0] > start_history_id]
+            offset = int(pageToken or 0)
+            page = records[offset:offset + maxResults]
+            response = {'historyId': str(self.history_id),
+                        'history': [{'id': str(history_id),
+                                     'messagesAdded': [{'message': {'id': message_id, 'labelIds': ['INBOX']}}]}
+                                    for history_id, message_id in page]}
+            if offset + maxResults < len(records):
+                response['nextPageToken'] = str(offset + maxResults)
+            return response
+        return FakeRequest(self, 'gmail.users.history.list', handler, fields=fields)
+
+    def _gmail(self):
+        messages = _Resource({
+            'list': self._list_messages,
+            'get': self._get_message,
+            'attachments': lambda: _Resource({'get': self._get_attachment}),
+        })
+        users = _Resource({
+            'messages': lambda: messages,
+            'history': lambda: _Resource({'list': self._list_history}),
+            'getProfile': lambda userId="me", fields=None: FakeRequest(
+                self, 'gmail.users.getProfile',
+                lambda: {'emailAddress': 'me@example.com', 'historyId': str(self.history_id)}, fields=fields),
+        })
+        return _Resource({
+            'users': lambda: users,
+            'new_batch_http_request': lambda callback=None: FakeBatchRequest(self, callback),
+        })
+
+    # -- Drive -------------------------------------------------------------
+
+    def _matches(self, file, q):
+        for clause in (q or "").split(" and "):
+            clause = clause.strip()
+            if not clause:
+                continue
+            match = re.fullmatch(r"(\w+)\s*=\s*'(.*)'", clause)
+            if match:
+                if file.get(match.group(1)) != match.group(2):
+                    return False
+                continue
+            match = re.fullmatch(r"'(.*)' in parents", clause)
+            if match:
+                if match.group(1) not in file['parents']:
+                    return False
+                continue
+            if clause == "trashed=false":
+                if file['trashed']:
+                    return False
+                continue
+            raise _http_error(400, f"Unsupported query clause: {clause}")
+        return True
+
+    def _list_files(self, q=None, spaces=None, fields=None, pageSize=100, pageToken=None, **kwargs):
+        def handler():
+            matches = [dict(id=file_id, name=file['name'], mimeType=file['mimeType'], parents=file['parents'])
+                       for file_id, file in list(self.files.items()) if self._matches(file, q)]
+            offset = int(pageToken or 0)
+            response = {'files': matches[offset:offset + pageSize]}
+            if offset + pageSize < len(matches):
+                response['nextPageToken'] = str(offset + pageSize)
+            return response
+        return FakeRequest(self, 'drive.files.list', handler, fields=fields)
+
+    def _get_file(self, fileId=None, fields=None, **kwargs):
+        def handler():
+            if fileId not in self.files:
+                raise _http_error(404, f"File not found: {fileId}")
+            file = self.files[fileId]
+            return {'id': fileId, 'name': file['name'], 'trashed': file['trashed']}
+        return FakeRequest(self, 'drive.files.get', handler, fields=fields)
+
+    def _create_file(self, body=None, media_body=None, fields=None, **kwargs):
+        size = media_body.size() if media_body is not None else 0
+
+        def handler():
+            for parent_id in body.get('parents', []):
+                if parent_id not in self.files or self.files[parent_id]['trashed']:
+                    raise _http_error(404, f"File not found: {parent_id}")
+            file_id = self._new_id('file')
+            with self._lock:
+                self.files[file_id] = {'name': body.get('name'), 'mimeType': body.get('mimeType'),
+                                       'parents': list(body.get('parents', [])), 'trashed': False,
+                                       'size': size}
+            return {'id': file_id}
+        return FakeRequest(self, 'drive.files.create', handler, size, fields)
+
+    def _update_file(self, fileId=None, body=None, media_body=None, fields=None, **kwargs):
+        size = media_body.size() if media_body is not None else 0
+
+        def handler():
+            if fileId not in self.files:
+                raise _http_error(404, f"File not found: {fileId}")
+            self.files[fileId]['size'] = size or self.files[fileId].get('size', 0)
+            return {'id': fileId}
+        return FakeRequest(self, 'drive.files.update', handler, size, fields)
+
+    def _drive(self):
+        files = _Resource({'list': self._list_files, 'get': self._get_file,
+                           'create': self._create_file, 'update': self._update_file})
+        return _Resource({'files': lambda: files})
+
+    # -- Sheets ------------------------------------------------------------
+
+    def _get_values(self, spreadsheetId=None, range=None, fields=None, **kwargs):
+        def handler():
+            rows = self.sheet_values.get(spreadsheetId, [])
+            response = {'range': range, 'majorDimension': 'ROWS'}
+            if rows:
+                response['values'] = rows[:1]
+            return response
+        return FakeRequest(self, 'sheets.spreadsheets.values.get', handler, fields=fields)
+
+    def _append_values(self, spreadsheetId=None, range=None, body=None, fields=None, **kwargs):
+        def handler():
+            with self._lock:
+                rows = self.sheet_values.setdefault(spreadsheetId, [])
+                first = len(rows) + 1
+                rows.extend(body['values'])
+            return {'updates': {'updatedRange': f"Sheet1!A{first}:D{len(rows)}",
+                                'updatedRows': len(body['values'])}}
+        return FakeRequest(self, 'sheets.spreadsheets.values.append', handler, fields=fields)
+
+    def _sheets(self):
+        values = _Resource({'get': self._get_values, 'append': self._append_values})
+        spreadsheets = _Resource({'values': lambda: values})
+        return _Resource({'spreadsheets': lambda: spreadsheets})
+
+    # -- Docs --------------------------------------------------------------
+
+    def _batch_update(self, documentId=None, body=None, fields=None, **kwargs):
+        inserted = sum(len(request['insertText']['text'].encode('utf-8'))
+                       for request in body.get('requests', []) if 'insertText' in request)
+
+        def handler():
+            if documentId not in self.files:
+                raise _http_error(404, f"Document not found: {documentId}")
+            with self._lock:
+                self.files[documentId]['size'] = self.files[documentId].get('size', 0) + inserted
+            return {'documentId': documentId, 'replies': [{} for _ in body.get('requests', [])]}
+        return FakeRequest(self, 'docs.documents.batchUpdate', handler, inserted, fields)
+
+    def _get_document(self, documentId=None, fields=None, **kwargs):
+        def handler():
+            if documentId not in self.files:
+                raise _http_error(404, f"Document not found: {documentId}")
+            return {'documentId': documentId, 'body': {'content': [{'endIndex': 1 + self.files[documentId].get('size', 0)}]}}
+        return FakeRequest(self, 'docs.documents.get', handler, fields=fields)
+
+    def _docs(self):
+        documents = _Resource({'batchUpdate': self._batch_update, 'get': self._get_document})
+        return _Resource({'documents': lambda: documents})
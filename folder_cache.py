@@ -0,0 +1,182 @@
+import threading
+from googleapiclient.errors import HttpError
+from concurrency import execute_request
+from helper import load_json_file, save_json_file
+from logger import logger
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FOLDER_CACHE_FILE = 'folder_cache.json'
+# Largest page size files().list allows
+DRIVE_LIST_PAGE_SIZE = 1000
+
+
+class FolderCache:
+    """
+    Persistent mapping of Drive folder paths to folder IDs.
+
+    Paths are '/'-joined folder names starting at the root folder, e.g.
+    'Email_data@Bdlaz/2024/11_2024/docs'. The cache is stored in a local JSON
+    file and validated on load with a single files().get on the root folder;
+    a subfolder deleted since is dropped when a write into it fails (see
+    evict). On a cache miss the whole folder tree is rebuilt from one paginated
+    files().list, and only folders that are still missing are created.
+    Lookups are safe to call from several threads; cache misses are
+    serialized so each folder is created at most once.
+    """
+
+    def __init__(self, service, root_name, cache_file=FOLDER_CACHE_FILE):
+        self.service = service
+        self.root_name = root_name
+        self.cache_file = cache_file
+        self.folders = {}
+        self._rebuilt = False
+        self._lock = threading.RLock()
+
+        cached = load_json_file(cache_file).get(root_name, {})
+        if cached and self._is_valid(cached.get(root_name)):
+            self.folders = cached
+            logger.info(f"Loaded {len(self.folders)} cached folder IDs for {root_name}")
+
+    def _is_valid(self, root_id):
+        if not root_id:
+            return False
+        try:
+            folder = execute_request(self.service.files().get(
+                fileId=root_id, fields="id, trashed"))
+        except HttpError as error:
+            if error.resp.status == 404:
+                logger.info(f"Cached {self.root_name} folder no longer exists")
+                return False
+            raise
+        return not folder.get('trashed', False)
+
+    def get_folder_id(self, *names):
+        """
+        Returns the ID of a folder below the root folder, creating it if needed.
+
+        Parameters:
+        - names: Folder names below the root, e.g. ("2024", "11_2024", "docs").
+
+        Returns:
+        - The folder ID.
+        """
+        path = "/".join((self.root_name,) + names)
+        if path in self.folders:
+            return self.folders[path]
+
+        with self._lock:
+            return self._get_or_create_folder_id(path, names)
+
+    def _get_or_create_folder_id(self, path, names):
+        # Another thread may have created the folder while we waited for the lock
+        if path in self.folders:
+            return self.folders[path]
+
+        if not self._rebuilt:
+            self.rebuild()
+            if path in self.folders:
+                return self.folders[path]
+
+        # Create every missing folder along the path
+        parent_path = self.root_name
+        if parent_path not in self.folders:
+            self.folders[parent_path] = self._create_folder(self.root_name, None)
+        for name in names:
+            folder_path = f"{parent_path}/{name}"
+            if folder_path not in self.folders:
+                self.folders[folder_path] = self._create_folder(
+                    name, self.folders[parent_path])
+            parent_path = folder_path
+        self.save()
+        return self.folders[path]
+
+    def evict(self, folder_id, *names):
+        """
+        Drops a folder that no longer exists in Drive, and every folder below
+        it, from the cache. Only the root folder is validated on load, so a
+        write into a deleted subfolder is how a stale entry shows up. The next
+        lookup lists Drive again, as the folder's parents may be gone too.
+
+        Parameters:
+        - folder_id: The stale ID; nothing is dropped if another thread has
+          already replaced it.
+        - names: Folder names below the root, as for get_folder_id.
+        """
+        path = "/".join((self.root_name,) + names)
+        with self._lock:
+            if self.folders.get(path) != folder_id:
+                return
+            logger.info(f"Cached folder {path} no longer exists")
+            self.folders = {folder_path: cached_id for folder_path, cached_id in self.folders.items()
+                            if folder_path != path and not folder_path.startswith(path + "/")}
+            self._rebuilt = False
+            self.save()
+
+    def rebuild(self):
+        """
+        Rebuilds the cache from a single paginated listing of all Drive folders.
+        """
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        logger.info(f"Started listing Drive folders to rebuild the folder cache")
+        folders_by_id = {}
+        page_token = None
+        while True:
+            results = execute_request(self.service.files().list(
+                q=f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false", spaces='drive',
+                pageSize=DRIVE_LIST_PAGE_SIZE, pageToken=page_token,
+                fields="nextPageToken, files(id, name, parents)"))
+            for folder in results.get('files', []):
+                folders_by_id[folder['id']] = folder
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        # Resolve paths in memory by walking each folder's parents up to the root
+        paths_by_id = {}
+
+        def resolve(folder_id):
+            if folder_id in paths_by_id:
+                return paths_by_id[folder_id]
+            folder = folders_by_id.get(folder_id)
+            path = None
+            if folder is not None:
+                parents = folder.get('parents', [])
+                parent_path = resolve(parents[0]) if parents else None
+                if parent_path is not None:
+                    path = f"{parent_path}/{folder['name']}"
+                elif folder['name'] == self.root_name:
+                    path = self.root_name
+            paths_by_id[folder_id] = path
+            return path
+
+        folders = {}
+        for folder_id in folders_by_id:
+            path = resolve(folder_id)
+            # Keep the first folder found for a path, like the name queries did
+            if path is not None and path not in folders:
+                folders[path] = folder_id
+
+        self.folders = folders
+        self._rebuilt = True
+        logger.info(f"Finished listing {len(folders_by_id)} Drive folders, {len(folders)} under {self.root_name}")
+        self.save()
+
+    def save(self):
+        with self._lock:
+            data = load_json_file(self.cache_file)
+            data[self.root_name] = dict(self.folders)
+            save_json_file(self.cache_file, data)
+
+    def _create_folder(self, name, parent_folder_id):
+        logger.info(f"Creating --> {name} folder")
+        file_metadata = {
+            'name': name,
+            'mimeType': FOLDER_MIME_TYPE,
+            'parents': [parent_folder_id] if parent_folder_id else []
+        }
+        folder = execute_request(
+            self.service.files().create(body=file_metadata, fields='id'))
+        return folder.get('id')
@@ -1,6 +1,15 @@
 from datetime import datetime, timedelta
+from email.utils import parsedate_tz
 import time
 import re
+import os
+import json
+import base64
+import codecs
+import hashlib
+import tempfile
+
+ADDRESS_PATTERN = re.compile(r"<(.*?)>")
 
 
 def get_text_between_tags(text):
@@ -14,12 +23,22 @@ def get_text_between_tags(text):
         return None
 
 
-def get_spreadsheet_file_name():
-    month = str(datetime.now().month)
+def get_spreadsheet_file_name(month=None):
+    month = str(month or datetime.now().month)
     file_name = "Month_"+month+"_Spreadsheet_Data"
     return file_name
 
 
+def get_doc_title(content_dict):
+    return "Email_"+content_dict['date']+"_full_message"
+
+
+def get_content_hash(content_dict):
+    # Identical for copies of the same email, whatever their message IDs
+    fields = (content_dict[key] for key in ('from', 'to', 'date', 'subject', 'message'))
+    return hashlib.sha256("\x00".join(fields).encode('utf-8')).hexdigest()
+
+
 def get_main_path():
     return "Email_data@Bdlaz"
 
@@ -38,29 +57,60 @@ def get_next_day_date():
 
 
 def join_non_empty_strings(*args):
-    # Filter out empty strings and join remaining with commas
-    return ", ".join([re.search(r"<(.*?)>", arg).group(1) for arg in args if re.search(r"<(.*?)>", arg)])
+    # Take the bracketed address from each non-empty string and join them with commas
+    matches = (ADDRESS_PATTERN.search(arg) for arg in args if arg)
+    return ", ".join([match.group(1) for match in matches if match])
 
 
-def extract_date_time_components(date_string):
-    try:
-        # Define the format of the input date string
-        date_format = "%a, %d %b %Y %H:%M:%S %z"
+def index_headers(headers):
+    # Map lower-cased header names to the first value seen, in a single pass
+    index = {}
+    for header in headers:
+        index.setdefault(header['name'].lower(), header['value'])
+    return index
 
-        # Parse the date string to a datetime object
-        date_obj = datetime.strptime(date_string, date_format)
 
-        # Extract and convert components to strings
-        day = str(date_obj.day)
-        # month = date_obj.strftime("%B")  # Full month name as a string
-        month = str(date_obj.month)
-        year = str(date_obj.year)
-        hour = str(date_obj.hour)
-        minute = str(date_obj.minute)
-        second = str(date_obj.second)
+def decode_body(data, charset="utf-8"):
+    # Decode base64url body data, tolerating missing padding, unknown
+    # charsets and invalid bytes instead of raising
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = "utf-8"
+    return raw.decode(charset, errors="replace")
 
-        return day, month, year, hour, minute, second
 
-    except ValueError:
-        # Return an empty tuple if the date string does not match the format
+def extract_date_time_components(date_string):
+    # parsedate_tz accepts the RFC 2822 variants seen in the wild, such as a
+    # trailing "(UTC)" or a missing weekday, and is much faster than strptime
+    parsed = parsedate_tz(date_string) if date_string else None
+    if parsed is None:
+        # Return placeholders if the date string cannot be parsed
         return 'D', 'M', 'Y', 'H', 'M', 'S'
+
+    # Extract and convert components to strings
+    year, month, day, hour, minute, second = parsed[:6]
+    return str(day), str(month), str(year), str(hour), str(minute), str(second)
+
+
+def load_json_file(path):
+    # Return the JSON object stored in `path`, or an empty dict if the file is missing
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file) or {}
+
+
+def save_json_file(path, data):
+    # Write to a temporary file first so an interrupted run never leaves a
+    # half-written checkpoint behind. Each writer gets its own temporary file,
+    # as backfill's shard processes save the folder cache and token at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=4)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,195 @@
+import threading
+from datetime import datetime, timezone
+from sqlalchemy import Column, DateTime, MetaData, String, Table, func, select
+from sqlalchemy.dialects.sqlite import insert
+from logger import logger
+from sqlite_db import QUERY_CHUNK_SIZE, create_sqlite_engine
+
+JOURNAL_FILE = 'export_journal.db'
+
+# Message states, in the order a message goes through them
+FETCHED = 'fetched'
+DOC_CREATED = 'doc_created'
+ROW_APPENDED = 'row_appended'
+# Messages without a readable body; nothing is exported for them
+SKIPPED = 'skipped'
+DONE_STATES = (ROW_APPENDED, SKIPPED)
+
+metadata = MetaData()
+
+messages_table = Table(
+    'messages', metadata,
+    Column('message_id', String, primary_key=True),
+    Column('status', String, nullable=False, index=True),
+    Column('doc_id', String),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+# The doc each thread is exported to in thread mode
+threads_table = Table(
+    'threads', metadata,
+    Column('thread_id', String, primary_key=True),
+    Column('doc_id', String, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+# The first message seen with each content hash; later copies are duplicates
+contents_table = Table(
+    'contents', metadata,
+    Column('content_hash', String, primary_key=True),
+    Column('message_id', String, nullable=False),
+)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class ExportJournal:
+    """
+    Durable record of how far each message has been exported, kept in a
+    local SQLite database.
+
+    Every state change is committed as soon as it happens, so after a crash
+    a rerun only repeats the work that was in flight: finished messages are
+    not fetched again, and messages whose doc exists only get their sheet row.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.engine = create_sqlite_engine(path)
+        metadata.create_all(self.engine)
+        # SQLite allows one writer at a time
+        self._lock = threading.Lock()
+
+    def get_states(self, message_ids):
+        """
+        Parameters:
+        - message_ids: Iterable of message IDs.
+
+        Returns:
+        - Dictionary mapping each journaled message ID to a (status, doc_id) tuple;
+          messages never seen before are left out.
+        """
+        message_ids = list(message_ids)
+        states = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(message_ids), QUERY_CHUNK_SIZE):
+                query = select(messages_table.c.message_id, messages_table.c.status, messages_table.c.doc_id) \
+                    .where(messages_table.c.message_id.in_(message_ids[start:start + QUERY_CHUNK_SIZE]))
+                for message_id, status, doc_id in connection.execute(query):
+                    states[message_id] = (status, doc_id)
+        return states
+
+    def unfinished_ids(self):
+        # Messages a previous run fetched but did not finish exporting
+        query = select(messages_table.c.message_id) \
+            .where(messages_table.c.status.in_((FETCHED, DOC_CREATED))) \
+            .order_by(messages_table.c.message_id)
+        with self.engine.connect() as connection:
+            return [row.message_id for row in connection.execute(query)]
+
+    def with_unfinished(self, message_ids):
+        """
+        Yields the unfinished messages of previous runs, then `message_ids`
+        without those already yielded.
+        """
+        unfinished = self.unfinished_ids()
+        if unfinished:
+            logger.info(f"Resuming {len(unfinished)} unfinished messages from {self.path}")
+        yield from unfinished
+        unfinished = set(unfinished)
+        for message_id in message_ids:
+            if message_id not in unfinished:
+                yield message_id
+
+    def mark_fetched(self, message_ids):
+        # Only records new messages; a message never moves back to 'fetched'
+        rows = [{'message_id': message_id, 'status': FETCHED, 'updated_at': _now()}
+                for message_id in message_ids]
+        if rows:
+            self._write(insert(messages_table).on_conflict_do_nothing(), rows)
+
+    def mark_doc_created(self, message_id, doc_id):
+        self._upsert([message_id], DOC_CREATED, doc_id)
+
+    def mark_rows_appended(self, message_ids):
+        self._upsert(message_ids, ROW_APPENDED)
+
+    def mark_skipped(self, message_id):
+        self._upsert([message_id], SKIPPED)
+
+    def get_thread_docs(self, thread_ids):
+        """
+        Returns:
+        - Dictionary mapping the thread IDs that already have a doc to its ID.
+        """
+        thread_ids = list(thread_ids)
+        docs = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(thread_ids), QUERY_CHUNK_SIZE):
+                query = select(threads_table.c.thread_id, threads_table.c.doc_id) \
+                    .where(threads_table.c.thread_id.in_(thread_ids[start:start + QUERY_CHUNK_SIZE]))
+                docs.update(connection.execute(query).all())
+        return docs
+
+    def set_thread_doc(self, thread_id, doc_id):
+        statement = insert(threads_table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[threads_table.c.thread_id],
+            set_={'doc_id': statement.excluded.doc_id, 'updated_at': statement.excluded.updated_at})
+        self._write(statement, [{'thread_id': thread_id, 'doc_id': doc_id, 'updated_at': _now()}])
+
+    def claim_contents(self, hashes):
+        """
+        Records each message as the owner of its content hash, unless another
+        message already owns it. Safe to call from several processes at once.
+
+        Parameters:
+        - hashes: Dictionary mapping message IDs to content hashes.
+
+        Returns:
+        - Dictionary mapping the messages that are duplicates to the message
+          owning their content.
+        """
+        rows = [{'content_hash': content_hash, 'message_id': message_id}
+                for message_id, content_hash in hashes.items()]
+        if not rows:
+            return {}
+        owners = {}
+        with self._lock, self.engine.begin() as connection:
+            connection.execute(insert(contents_table).on_conflict_do_nothing(), rows)
+            for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+                chunk = [row['content_hash'] for row in rows[start:start + QUERY_CHUNK_SIZE]]
+                query = select(contents_table.c.content_hash, contents_table.c.message_id) \
+                    .where(contents_table.c.content_hash.in_(chunk))
+                owners.update(connection.execute(query).all())
+        return {message_id: owners[content_hash] for message_id, content_hash in hashes.items()
+                if owners[content_hash] != message_id}
+
+    def counts(self):
+        # Number of messages per status
+        query = select(messages_table.c.status, func.count()).group_by(messages_table.c.status)
+        with self.engine.connect() as connection:
+            return dict(connection.execute(query).all())
+
+    def close(self):
+        self.engine.dispose()
+
+    def _upsert(self, message_ids, status, doc_id=None):
+        rows = [{'message_id': message_id, 'status': status, 'doc_id': doc_id, 'updated_at': _now()}
+                for message_id in message_ids]
+        if not rows:
+            return
+        statement = insert(messages_table)
+        # Keep a doc ID recorded earlier when a later state does not carry one
+        statement = statement.on_conflict_do_update(
+            index_elements=[messages_table.c.message_id],
+            set_={'status': statement.excluded.status,
+                  'doc_id': statement.excluded.doc_id if doc_id else messages_table.c.doc_id,
+                  'updated_at': statement.excluded.updated_at})
+        self._write(statement, rows)
+
+    def _write(self, statement, rows):
+        with self._lock, self.engine.begin() as connection:
+            connection.execute(statement, rows)
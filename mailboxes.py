@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from auth import TOKEN_FILE, get_authenticated_services, get_credentials
+from concurrency import API_RATE_LIMITS, PER_USER_APIS, ApiWorkerPools, FairTokenBucket, MailboxQuota, current_quota, get_rate_limit
+from drive import LazyFolderDict
+from folder_cache import FolderCache
+from helper import get_main_path, load_json_file
+from logger import logger
+from main import run_export
+from metrics import MetricsReporter, api_metrics
+from sinks import LOCAL_EXPORT_DIR
+
+# Exports several mailboxes at once into one Drive account, e.g.
+#
+#   python mailboxes.py 2024/11/14 2024/11/22 --config mailboxes.json
+#
+# with mailboxes.json listing each mailbox's token file and optional
+# per-mailbox rate limits (requests, or Gmail quota units, per second):
+#
+#   [{"name": "support", "token_file": "tokens/support.json", "limits": {"drive": 3}},
+#    {"name": "sales", "token_file": "tokens/sales.json"}]
+
+MAILBOXES_FILE = 'mailboxes.json'
+# Checkpoint, journal and message cache of each mailbox go in their own directory here
+MAILBOX_STATE_DIR = 'mailbox_state'
+
+
+def load_mailboxes(path=MAILBOXES_FILE):
+    """
+    Reads the mailbox list.
+
+    Returns:
+    - List of dictionaries with the 'name', 'token_file' and 'limits' of each mailbox.
+    """
+    mailboxes = []
+    for entry in load_json_file(path):
+        name = entry['name']
+        if not re.fullmatch(r"[\w.@+-]+", name):
+            raise ValueError(f"Mailbox name {name!r} cannot be used as a folder name")
+        mailboxes.append({'name': name, 'token_file': entry['token_file'], 'limits': entry.get('limits', {})})
+    if len({mailbox['name'] for mailbox in mailboxes}) != len(mailboxes):
+        raise ValueError(f"Mailbox names in {path} must be unique")
+    return mailboxes
+
+
+def get_mailbox_state_files(name, state_dir=MAILBOX_STATE_DIR):
+    # (checkpoint_file, journal_file, cache_file) of one mailbox
+    directory = os.path.join(state_dir, name)
+    os.makedirs(directory, exist_ok=True)
+    return (os.path.join(directory, 'checkpoint.json'), os.path.join(directory, 'export_journal.db'),
+            os.path.join(directory, 'message_cache.db'))
+
+
+def gmail_service_for(mailbox):
+    # Default Gmail factory: the mailbox's own token, with its own connections
+    return get_authenticated_services(get_credentials(mailbox['token_file']), token_file=mailbox['token_file'])[0]
+
+
+def run_mailboxes(mailboxes, sheet_service, drive_service, start_date, end_date, gmail_factory=gmail_service_for,
+                  docs_service=None, concurrency=None, thread_mode=False, dedupe=False, outputs=('google',),
+                  local_dir=LOCAL_EXPORT_DIR, local_format='jsonl', state_dir=MAILBOX_STATE_DIR, write_docs=True):
+    """
+    Exports several mailboxes concurrently into one Drive account.
+
+    Each mailbox runs its own pipeline with its own checkpoint and journal,
+    and writes below its own folder, get_main_path()/<name>/YYYY/..., with
+    its own monthly spreadsheets. Gmail quotas are per user, so every mailbox
+    has its own Gmail limiter. The Drive, Docs and Sheets quotas of the output
+    account are shared: their limiters (FairTokenBucket) serve the mailboxes
+    in turn, so a large mailbox cannot starve the others. Every mailbox's API
+    usage is counted in its MailboxQuota.
+
+    Parameters:
+    - mailboxes: List of mailboxes, as returned by load_mailboxes.
+    - sheet_service, drive_service, docs_service: Services of the output account.
+    - start_date (str): Start of the fallback window in 'YYYY/MM/DD' format.
+    - end_date (str): End of the fallback window in 'YYYY/MM/DD' format.
+    - gmail_factory: Function returning the Gmail service of a mailbox.
+    - concurrency (int): Mailboxes exported at once (all of them if None).
+    - thread_mode, dedupe, outputs, local_format, write_docs: As for main.run.
+    - local_dir (str): The 'local' sink writes to a directory per mailbox in here.
+    - state_dir (str): Directory for the per-mailbox state files.
+
+    Returns:
+    - Dictionary of per-mailbox results: 'status' ('done' or 'failed'),
+      per-stage 'stats', API 'quota' usage and 'seconds' taken.
+    """
+    shared_limiters = {api: FairTokenBucket(get_rate_limit(api))
+                       for api in API_RATE_LIMITS if api not in PER_USER_APIS}
+    # One folder cache for every mailbox, so the shared root folder and the
+    # cache file are not raced for
+    folder_cache = FolderCache(drive_service, get_main_path())
+    pools = ApiWorkerPools()
+
+    def export(mailbox):
+        start = time.monotonic()
+        quota = MailboxQuota(mailbox['name'], shared_limiters, mailbox['limits'])
+        # Every API call made for this mailbox, from any worker thread, goes through its quota
+        current_quota.set(quota)
+        result = {'status': 'failed'}
+        try:
+            checkpoint_file, journal_file, cache_file = get_mailbox_state_files(mailbox['name'], state_dir)
+            stats = run_export(gmail_factory(mailbox), sheet_service, drive_service, start_date, end_date, pools,
+                               journal_file, cache_file, docs_service=docs_service, thread_mode=thread_mode,
+                               dedupe=dedupe, outputs=outputs, local_dir=os.path.join(local_dir, mailbox['name']),
+                               local_format=local_format, checkpoint_file=checkpoint_file,
+                               folder_dict=LazyFolderDict(folder_cache, prefix=(mailbox['name'],)),
+                               write_docs=write_docs)
+            result['stats'] = stats
+            if not any(stage['errors'] for stage in stats.values()):
+                result['status'] = 'done'
+        except Exception as error:
+            logger.exception(f"Mailbox {mailbox['name']} failed: {error}")
+            result['error'] = str(error)
+        result['quota'] = quota.summary()
+        result['seconds'] = round(time.monotonic() - start, 1)
+        logger.info(f"Mailbox {mailbox['name']} {result['status']} in {result['seconds']}s, "
+                    f"quota used: {result['quota']['used']}")
+        return result
+
+    logger.info(f"Exporting {len(mailboxes)} mailboxes")
+    with ThreadPoolExecutor(max_workers=concurrency or len(mailboxes) or 1, thread_name_prefix="mailbox") as executor:
+        return dict(zip([mailbox['name'] for mailbox in mailboxes], executor.map(export, mailboxes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export several mailboxes into one Drive account")
+    parser.add_argument("start_date", help="YYYY/MM/DD")
+    parser.add_argument("end_date", help="YYYY/MM/DD")
+    parser.add_argument("--config", default=MAILBOXES_FILE)
+    parser.add_argument("--token", default=TOKEN_FILE, help="Token of the account the exports are written to")
+    parser.add_argument("--concurrency", type=int, default=None, help="Mailboxes exported at once")
+    parser.add_argument("--metrics-interval", type=float, default=None)
+    parser.add_argument("--threads", action="store_true", help="Write one doc per thread")
+    parser.add_argument("--dedupe", action="store_true", help="Skip emails already exported under another ID")
+    parser.add_argument("--no-docs", action="store_true", help="Only write sheet rows, without fetching bodies")
+    args = parser.parse_args()
+
+    _, sheet_service, drive_service, docs_service = get_authenticated_services(
+        get_credentials(args.token), token_file=args.token)
+    mailboxes = load_mailboxes(args.config)
+    api_metrics.reset()
+    if args.metrics_interval:
+        with MetricsReporter(api_metrics, args.metrics_interval):
+            results = run_mailboxes(mailboxes, sheet_service, drive_service, args.start_date, args.end_date,
+                                    docs_service=docs_service, concurrency=args.concurrency,
+                                    thread_mode=args.threads, dedupe=args.dedupe, write_docs=not args.no_docs)
+    else:
+        results = run_mailboxes(mailboxes, sheet_service, drive_service, args.start_date, args.end_date,
+                                docs_service=docs_service, concurrency=args.concurrency,
+                                thread_mode=args.threads, dedupe=args.dedupe, write_docs=not args.no_docs)
+    print(json.dumps({name: {key: value for key, value in result.items() if key != 'stats'}
+                      for name, result in results.items()}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,29 @@
-from auth import get_authenticated_services
-from emails import get_emails_in_date_range
+import time
+from auth import get_authenticated_services, get_credentials
+from concurrency import ApiWorkerPools
+from emails import CHECKPOINT_FILE, get_new_message_ids
 from datetime import datetime
-from drive import create_folder_in_drive, create_and_write_doc_in_folder
-from helper import get_main_path
+from journal import JOURNAL_FILE, ExportJournal
+from pipeline import run_email_pipeline
+from sinks import LOCAL_EXPORT_DIR, build_sinks
 from logger import logger
+from message_cache import MESSAGE_CACHE_FILE, MessageCache
+from metrics import MetricsReporter, api_metrics
+
+# Per-API-call report written at the end of a run ('.prom' for Prometheus text)
+METRICS_FILE = "run_metrics.json"
+# Seconds between live metrics log lines
+METRICS_LOG_INTERVAL = 60
+# Write one doc per Gmail thread instead of one per email
+THREAD_MODE = False
+# Skip emails whose content was already exported under another message ID
+DEDUPE_EMAILS = False
+# Where emails are exported to (see sinks.SINKS); 'local' writes monthly
+# JSONL files to LOCAL_EXPORT_DIR alongside or instead of Google Drive
+OUTPUTS = ('google',)
+# Write a doc per email; without docs only the sheet rows are written and
+# messages are fetched as metadata, without their bodies
+WRITE_DOCS = True
 
 # def get_date_string():
 #     today = datetime.date.today()
@@ -15,24 +35,112 @@ from logger import logger
 #     return date_string_with_seconds  # Output: 2023-11-08 00:00:00
 
 
-if __name__ == "__main__":
-    gmail_service, sheet_service, drive_service, doc_service = get_authenticated_services()
-    data = get_emails_in_date_range(gmail_service, "2024/11/14", "2024/11/22")
-    logger.info(f"Finished processing fetched email data")
-    if isinstance(data, list):
-        spreadsheet_folder_id_dict = create_folder_in_drive(
-            drive_service, get_main_path(), "spreadsheet")
-        folder_dict = create_folder_in_drive(
-            drive_service, get_main_path(), "docs")
-        logger.info(f"Started writing data to docs and spreadsheet")
-        for msg in data:
-            date = msg['date']
-            subject = msg['subject']
-            msg_text = msg['message']
-            title = "Email_"+date+"_full_message"
-            create_and_write_doc_in_folder(
-                sheet_service, drive_service, doc_service, folder_dict, spreadsheet_folder_id_dict, title, msg)
-        logger.info(f"Finished writing data to docs and spreadsheet")
+def run(gmail_service, sheet_service, drive_service, start_date, end_date, pools=None,
+        metrics_file=None, metrics_interval=None, journal_file=JOURNAL_FILE,
+        cache_file=MESSAGE_CACHE_FILE, docs_service=None, thread_mode=False, dedupe=False,
+        outputs=OUTPUTS, local_dir=LOCAL_EXPORT_DIR, local_format='jsonl', checkpoint_file=CHECKPOINT_FILE,
+        write_docs=WRITE_DOCS):
+    """
+    Exports emails added since the previous run to Google Docs and the monthly spreadsheets.
+
+    Parameters:
+    - gmail_service, sheet_service, drive_service: API service instances, as
+      returned by get_authenticated_services.
+    - start_date (str): Start of the fallback window in 'YYYY/MM/DD' format.
+    - end_date (str): End of the fallback window in 'YYYY/MM/DD' format.
+    - pools: An ApiWorkerPools instance (a default one is created if None).
+    - metrics_file (str): Where to write the API call report (no report if None).
+    - metrics_interval (float): Seconds between live metrics log lines (none if None).
+    - journal_file (str): SQLite file recording each message's export progress.
+    - cache_file (str): SQLite file caching fetched messages (no cache if None).
+    - docs_service: The Docs API service instance, needed in thread mode.
+    - thread_mode (bool): Write one doc per thread (see sinks.GoogleSink).
+    - dedupe (bool): Skip emails whose content was already exported.
+    - outputs: Names of the sinks to export to (see sinks.SINKS).
+    - local_dir, local_format: Directory and format of the 'local' sink's files.
+    - checkpoint_file (str): JSON file holding the sync checkpoint. A run
+      with different outputs needs its own checkpoint and journal files.
+    - write_docs (bool): Write a doc per email; False writes only the sheet
+      rows, fetching messages without their bodies (see sinks.GoogleSink).
+
+    Returns:
+    - Dictionary of per-stage pipeline statistics.
+    """
+    # Worker pool sizes per API; the services already give each thread its own Http
+    pools = pools or ApiWorkerPools()
+    options = {'docs_service': docs_service, 'thread_mode': thread_mode, 'dedupe': dedupe, 'outputs': outputs,
+               'local_dir': local_dir, 'local_format': local_format, 'checkpoint_file': checkpoint_file,
+               'write_docs': write_docs}
+    api_metrics.reset()
+    try:
+        if metrics_interval:
+            with MetricsReporter(api_metrics, metrics_interval):
+                return run_export(gmail_service, sheet_service, drive_service, start_date, end_date, pools,
+                                  journal_file, cache_file, **options)
+        return run_export(gmail_service, sheet_service, drive_service, start_date, end_date, pools,
+                          journal_file, cache_file, **options)
+    finally:
+        if metrics_file:
+            api_metrics.write_report(metrics_file)
+            logger.info(f"API call metrics written to {metrics_file}")
+
+
+def run_export(gmail_service, sheet_service, drive_service, start_date, end_date, pools, journal_file, cache_file,
+               docs_service=None, thread_mode=False, dedupe=False, outputs=OUTPUTS, local_dir=LOCAL_EXPORT_DIR,
+               local_format='jsonl', checkpoint_file=CHECKPOINT_FILE, folder_dict=None, write_docs=WRITE_DOCS):
+    """
+    Exports the emails of one mailbox added since its previous run, without
+    resetting or reporting the API metrics, so several mailboxes can be
+    exported at once (see mailboxes.run_mailboxes).
+
+    Parameters:
+    - pools: An ApiWorkerPools instance.
+    - folder_dict: Folder mapping for the 'google' sink (see sinks.build_sinks).
+    - The others as for run.
+
+    Returns:
+    - Dictionary of per-stage pipeline statistics.
+    """
+    journal = ExportJournal(journal_file)
+    # Incremental sync via the stored history ID; the date range is only
+    # scanned in full on the first run or when the history has expired
+    message_ids = get_new_message_ids(gmail_service, start_date, end_date, checkpoint_file)
+    # Messages an interrupted run left unfinished are exported again first
+    source = journal.with_unfinished(message_ids)
+
+    # Messages fetched by earlier runs are read from disk instead of Gmail
+    cache = MessageCache(cache_file) if cache_file else None
+    sinks = build_sinks(outputs, sheet_service, drive_service, pools, journal, docs_service, thread_mode,
+                        local_dir, local_format, folder_dict=folder_dict, write_docs=write_docs)
+    logger.info(f"Started writing data to {', '.join(outputs)}")
+    try:
+        # Listing, fetching, parsing and writing run as concurrent stages,
+        # so writing starts before the whole range has been listed
+        stats = run_email_pipeline(gmail_service, source, sinks, pools, journal=journal, cache=cache,
+                                   thread_mode=thread_mode, dedupe=dedupe)
+    finally:
+        for sink in sinks:
+            sink.close()
+        journal.close()
+        if cache is not None:
+            cache.close()
+    logger.info(f"Finished writing data to {', '.join(outputs)}")
+    # Only advance the checkpoint when every email made it through; the
+    # journal keeps track of the failed ones either way
+    if any(stage['errors'] for stage in stats.values()):
+        logger.warning("Some emails failed, the checkpoint was not advanced")
     else:
-        logger.info(f"Data already present")
-        raise Exception(data)
+        message_ids.commit()
+    return stats
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    creds = get_credentials()
+    # Clients are built on first use; the Docs client is only used in thread mode
+    gmail_service, sheet_service, drive_service, doc_service = get_authenticated_services(creds)
+    logger.info(f"Loaded credentials and services in {(time.perf_counter() - start) * 1000:.0f} ms")
+    run(gmail_service, sheet_service, drive_service, "2024/11/14", "2024/11/22",
+        metrics_file=METRICS_FILE, metrics_interval=METRICS_LOG_INTERVAL,
+        docs_service=doc_service, thread_mode=THREAD_MODE, dedupe=DEDUPE_EMAILS, outputs=OUTPUTS,
+        write_docs=WRITE_DOCS)
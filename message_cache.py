@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+import zlib
+from sqlalchemy import Column, Float, Integer, LargeBinary, MetaData, String, Table, delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from logger import logger
+from sqlite_db import QUERY_CHUNK_SIZE, create_sqlite_engine
+
+MESSAGE_CACHE_FILE = 'message_cache.db'
+# Compressed bytes kept on disk before the least recently used messages are evicted
+MESSAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Evict down to this fraction of the cap, so eviction does not run on every insert
+EVICTION_TARGET = 0.9
+COMPRESSION_LEVEL = 6
+
+metadata = MetaData()
+
+messages_table = Table(
+    'messages', metadata,
+    Column('message_id', String, primary_key=True),
+    Column('data', LargeBinary, nullable=False),
+    Column('size', Integer, nullable=False),
+    Column('last_used', Float, nullable=False, index=True),
+)
+
+
+class MessageCache:
+    """
+    On-disk cache of full Gmail message resources, keyed by message ID.
+
+    Gmail messages never change once delivered, so a cached copy is always
+    current. Messages are stored as zlib-compressed JSON in a SQLite file;
+    once the compressed total exceeds `max_bytes` the least recently used
+    messages are evicted.
+    """
+
+    def __init__(self, path=MESSAGE_CACHE_FILE, max_bytes=MESSAGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.engine = create_sqlite_engine(path)
+        metadata.create_all(self.engine)
+        self._lock = threading.Lock()
+        with self.engine.connect() as connection:
+            self.total_bytes = connection.execute(
+                select(func.coalesce(func.sum(messages_table.c.size), 0))).scalar()
+
+    def get(self, message_id):
+        return self.get_many([message_id]).get(message_id)
+
+    def get_many(self, message_ids):
+        """
+        Parameters:
+        - message_ids: Iterable of message IDs.
+
+        Returns:
+        - Dictionary mapping the cached message IDs to their message resources.
+        """
+        message_ids = list(message_ids)
+        messages = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(message_ids), QUERY_CHUNK_SIZE):
+                query = select(messages_table.c.message_id, messages_table.c.data) \
+                    .where(messages_table.c.message_id.in_(message_ids[start:start + QUERY_CHUNK_SIZE]))
+                for message_id, data in connection.execute(query):
+                    messages[message_id] = json.loads(zlib.decompress(data))
+
+        with self._lock:
+            self.hits += len(messages)
+            self.misses += len(message_ids) - len(messages)
+            if messages:
+                # Mark the hits as recently used
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        update(messages_table)
+                        .where(messages_table.c.message_id.in_(list(messages)))
+                        .values(last_used=time.time()))
+        return messages
+
+    def put(self, message):
+        self.put_many([message])
+
+    def put_many(self, messages):
+        # Store full message resources, evicting old ones if over the cap
+        now = time.time()
+        rows = {}
+        for message in messages:
+            data = zlib.compress(json.dumps(message, separators=(',', ':')).encode(), COMPRESSION_LEVEL)
+            rows[message['id']] = {'message_id': message['id'], 'data': data, 'size': len(data), 'last_used': now}
+        if not rows:
+            return
+
+        with self._lock, self.engine.begin() as connection:
+            # A message already cached is replaced, e.g. by the same message
+            # with its attachment-stored body downloaded
+            message_ids = list(rows)
+            for start in range(0, len(message_ids), QUERY_CHUNK_SIZE):
+                self.total_bytes -= connection.execute(
+                    select(func.coalesce(func.sum(messages_table.c.size), 0))
+                    .where(messages_table.c.message_id.in_(message_ids[start:start + QUERY_CHUNK_SIZE]))).scalar()
+            statement = insert(messages_table)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[messages_table.c.message_id],
+                set_={'data': statement.excluded.data, 'size': statement.excluded.size,
+                      'last_used': statement.excluded.last_used}), list(rows.values()))
+            self.total_bytes += sum(row['size'] for row in rows.values())
+            if self.total_bytes > self.max_bytes:
+                self._evict(connection)
+
+    def _evict(self, connection):
+        # Delete the least recently used messages down to EVICTION_TARGET of the cap
+        target = self.max_bytes * EVICTION_TARGET
+        evicted = []
+        query = select(messages_table.c.message_id, messages_table.c.size) \
+            .order_by(messages_table.c.last_used)
+        for message_id, size in connection.execute(query).all():
+            if self.total_bytes <= target:
+                break
+            evicted.append(message_id)
+            self.total_bytes -= size
+        for start in range(0, len(evicted), QUERY_CHUNK_SIZE):
+            connection.execute(delete(messages_table).where(
+                messages_table.c.message_id.in_(evicted[start:start + QUERY_CHUNK_SIZE])))
+        logger.info(f"Evicted {len(evicted)} messages from the message cache")
+
+    def close(self):
+        if self.hits or self.misses:
+            logger.info(f"Message cache: {self.hits} hits, {self.misses} misses, "
+                        f"{self.total_bytes / 1024 ** 2:.1f} MB on disk")
+        self.engine.dispose()
@@ -0,0 +1,291 @@
+import json
+import math
+import threading
+import time
+from logger import logger
+
+
+class Histogram:
+    """
+    Thread-safe latency histogram with logarithmic buckets.
+
+    Memory stays constant however many values are recorded; percentiles are
+    accurate to within one bucket (about 10%).
+    """
+
+    # Bucket i covers values up to MIN_VALUE * GROWTH ** i seconds
+    MIN_VALUE = 1e-6
+    GROWTH = 1.1
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        index = 0 if value <= self.MIN_VALUE else \
+            math.ceil(math.log(value / self.MIN_VALUE, self.GROWTH))
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the given percentile
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = math.ceil(self.count * percent / 100)
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    return min(self.MIN_VALUE * self.GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class CallStats:
+    """
+    Counters for one API method, e.g. 'drive.files.list'.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        # Failed attempts by HTTP status (or exception name)
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Seconds spent waiting for the API's rate limiter
+        self.throttled = 0.0
+        self.latency = Histogram()
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'errors': dict(self.errors),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'throttled_seconds': round(self.throttled, 3),
+            'latency': self.latency.summary(),
+        }
+
+
+class ApiMetrics:
+    """
+    Thread-safe per-method statistics for Google API calls.
+
+    concurrency.execute_request records every attempt; the transport
+    (see transport.py) adds the bytes sent and received to the call the
+    current thread is executing, and counts HTTP requests and the
+    connections opened for them.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.http_requests = 0
+        self.connections_opened = 0
+        self.avoided_calls = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, method):
+        stats = self._stats.get(method)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(method, CallStats())
+        return stats
+
+    def begin(self, method):
+        # Marks `method` as the call in progress on this thread
+        self._local.method = method
+
+    def end(self):
+        self._local.method = None
+
+    def record_call(self, method, duration, error=None):
+        """
+        Records one attempt of a call.
+
+        Parameters:
+        - method (str): The API method ID.
+        - duration (float): Seconds the attempt took.
+        - error: HTTP status or exception name if the attempt failed.
+        """
+        stats = self.get(method)
+        stats.latency.record(duration)
+        with self._lock:
+            stats.calls += 1
+            if error is not None:
+                stats.errors[str(error)] = stats.errors.get(str(error), 0) + 1
+
+    def record_retry(self, method):
+        stats = self.get(method)
+        with self._lock:
+            stats.retries += 1
+
+    def record_throttle(self, method, seconds):
+        stats = self.get(method)
+        with self._lock:
+            stats.throttled += seconds
+
+    def record_transfer(self, sent, received):
+        # Requests made outside execute_request (e.g. discovery) are 'untracked'
+        stats = self.get(getattr(self._local, 'method', None) or 'untracked')
+        with self._lock:
+            self.http_requests += 1
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+
+    def record_connection_opened(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def record_avoided(self, reason, count=1):
+        # Calls the exporter did not have to make, e.g. for a duplicate email
+        with self._lock:
+            self.avoided_calls[reason] = self.avoided_calls.get(reason, 0) + count
+
+    def connection_reuse_ratio(self):
+        # Share of HTTP requests sent over an already open connection
+        if not self.http_requests:
+            return 0.0
+        return max(0.0, 1 - self.connections_opened / self.http_requests)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.http_requests = 0
+            self.connections_opened = 0
+            self.avoided_calls = {}
+            self.started = time.monotonic()
+
+    def snapshot(self):
+        """
+        Returns:
+        - Dictionary with the elapsed seconds, transport counters, avoided calls
+          by reason and a summary per method.
+        """
+        with self._lock:
+            methods = sorted(self._stats.items())
+        return {
+            'elapsed_seconds': round(time.monotonic() - self.started, 3),
+            'transport': {
+                'http_requests': self.http_requests,
+                'connections_opened': self.connections_opened,
+                'connection_reuse_ratio': round(self.connection_reuse_ratio(), 4),
+            },
+            'avoided_calls': dict(sorted(self.avoided_calls.items())),
+            'methods': {method: stats.summary() for method, stats in methods},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=4)
+
+    def to_prometheus(self):
+        """
+        Returns:
+        - The statistics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        methods = snapshot['methods']
+        metric("google_api_calls_total", "counter", "API call attempts.",
+               [({'method': method}, stats['calls']) for method, stats in methods.items()])
+        metric("google_api_retries_total", "counter", "Retried API call attempts.",
+               [({'method': method}, stats['retries']) for method, stats in methods.items()])
+        metric("google_api_errors_total", "counter", "Failed API call attempts by status.",
+               [({'method': method, 'status': status}, count)
+                for method, stats in methods.items() for status, count in stats['errors'].items()])
+        metric("google_api_sent_bytes_total", "counter", "Request bytes sent.",
+               [({'method': method}, stats['bytes_sent']) for method, stats in methods.items()])
+        metric("google_api_received_bytes_total", "counter", "Response bytes received.",
+               [({'method': method}, stats['bytes_received']) for method, stats in methods.items()])
+        metric("google_api_throttled_seconds_total", "counter", "Seconds spent waiting for the rate limiter.",
+               [({'method': method}, stats['throttled_seconds']) for method, stats in methods.items()])
+        metric("google_api_latency_seconds", "summary", "API call latency.",
+               [({'method': method, 'quantile': quantile}, stats['latency'][key])
+                for method, stats in methods.items() for quantile, key in (('0.5', 'p50'), ('0.99', 'p99'))])
+        lines.extend(f"google_api_latency_seconds_count{{method=\"{method}\"}} {stats['latency']['count']}"
+                     for method, stats in methods.items())
+        transport = snapshot['transport']
+        metric("google_api_http_requests_total", "counter", "HTTP requests sent.",
+               [({}, transport['http_requests'])])
+        metric("google_api_connections_opened_total", "counter", "HTTP connections opened.",
+               [({}, transport['connections_opened'])])
+        metric("google_api_connection_reuse_ratio", "gauge", "Share of HTTP requests sent over an open connection.",
+               [({}, transport['connection_reuse_ratio'])])
+        metric("google_api_calls_avoided_total", "counter", "API calls avoided by reason.",
+               [({'reason': reason}, count) for reason, count in snapshot['avoided_calls'].items()])
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path):
+        # Prometheus text for '.prom' files, JSON otherwise
+        with open(path, "w") as file:
+            file.write(self.to_prometheus() if path.endswith(".prom") else self.to_json())
+
+
+class MetricsReporter:
+    """
+    Background thread that logs a one-line summary of the API calls every
+    `interval` seconds. Use as a context manager around a run.
+    """
+
+    def __init__(self, metrics, interval=60):
+        self.metrics = metrics
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            logger.info(self.format_line())
+
+    def format_line(self):
+        snapshot = self.metrics.snapshot()
+        methods = snapshot['methods']
+        calls = sum(stats['calls'] for stats in methods.values())
+        errors = sum(sum(stats['errors'].values()) for stats in methods.values())
+        retries = sum(stats['retries'] for stats in methods.values())
+        rate = calls / snapshot['elapsed_seconds'] if snapshot['elapsed_seconds'] else 0.0
+        # The three methods with the most time spent in calls
+        busiest = sorted(methods.items(), key=lambda item: -item[1]['latency']['mean'] * item[1]['calls'])[:3]
+        top = ", ".join(f"{method} {stats['calls']} calls p99 {stats['latency']['p99'] * 1000:.0f}ms"
+                        for method, stats in busiest)
+        reuse = snapshot['transport']['connection_reuse_ratio']
+        return (f"API calls: {calls} ({rate:.1f}/s), {retries} retries, {errors} errors, "
+                f"{reuse:.0%} connection reuse" + (f"; busiest: {top}" if top else ""))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+# Statistics for every request made through concurrency.execute_request
+api_metrics = ApiMetrics()
@@ -0,0 +1,326 @@
+import contextvars
+import queue
+import threading
+import time
+from emails import GMAIL_BATCH_SIZE, MAX_BODY_BYTES, fetch_messages_batch, parse_email_details
+from helper import get_content_hash
+from journal import DONE_STATES
+from logger import logger
+from metrics import Histogram, api_metrics
+
+# Marks the end of a stage's input
+_END = object()
+
+
+class Stage:
+    """
+    A pool of worker threads that reads items from a bounded input queue.
+
+    `fn(item)` returns an iterable of items for the next stage (or None).
+    A full input queue blocks the previous stage, so each stage applies
+    backpressure to the one before it.
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=100):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.input = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.errors = 0
+        # Time spent in `fn` per item
+        self.latency = Histogram()
+        self._running = workers
+        self._lock = threading.Lock()
+
+
+class Pipeline:
+    """
+    Streams items from a source through a chain of stages connected by
+    bounded queues.
+
+    Every stage runs concurrently with its own workers, so the first items
+    reach the last stage while the source is still producing, and memory is
+    bounded by the queue sizes rather than by the number of items.
+
+    The chain can end in several branches, final stages that each receive
+    every item of the last stage. A branch whose queue is full holds up the
+    others, so the slowest branch sets the pace.
+    """
+
+    def __init__(self, source, source_name="source"):
+        self.source = source
+        self.source_name = source_name
+        self.source_error = None
+        self.produced = 0
+        self.stages = []
+        self.branches = []
+
+    def add_stage(self, name, fn, workers=1, queue_size=100):
+        self.stages.append(Stage(name, fn, workers, queue_size))
+        return self
+
+    def add_branch(self, name, fn, workers=1, queue_size=100):
+        # A final stage fed with every item of the last stage added with add_stage
+        self.branches.append(Stage(name, fn, workers, queue_size))
+        return self
+
+    def run(self):
+        """
+        Runs the pipeline until the source is exhausted and every stage has drained.
+
+        Item failures inside a stage are logged and counted; an error raised
+        by the source is re-raised once the items already produced have been
+        processed.
+
+        Returns:
+        - Dictionary of per-stage 'processed' and 'errors' counts and 'latency'
+          summaries (seconds per item).
+        """
+        # Every thread runs in the caller's context, e.g. its mailbox quota (see concurrency.current_quota)
+        threads = [threading.Thread(
+            target=contextvars.copy_context().run, args=(self._feed,), name=f"{self.source_name}-0", daemon=True)]
+        for index, stage in enumerate(self.stages + self.branches):
+            if index + 1 < len(self.stages):
+                outputs = [self.stages[index + 1].input]
+            elif index + 1 == len(self.stages):
+                outputs = [branch.input for branch in self.branches]
+            else:
+                outputs = []
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=contextvars.copy_context().run, args=(self._work, stage, outputs),
+                    name=f"{stage.name}-{worker}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = {self.source_name: {'processed': self.produced, 'errors': int(self.source_error is not None)}}
+        stats.update({stage.name: {'processed': stage.processed, 'errors': stage.errors,
+                                   'latency': stage.latency.summary()}
+                      for stage in self.stages + self.branches})
+        logger.info(f"Pipeline finished: {stats}")
+        if self.source_error is not None:
+            raise self.source_error
+        return stats
+
+    def _feed(self):
+        output = self.stages[0].input
+        try:
+            for item in self.source:
+                output.put(item)
+                self.produced += 1
+        except Exception as error:
+            logger.exception(f"Stage {self.source_name} failed: {error}")
+            self.source_error = error
+        finally:
+            output.put(_END)
+
+    def _work(self, stage, outputs):
+        while True:
+            item = stage.input.get()
+            if item is _END:
+                # Leave the marker for the other workers of this stage; the
+                # last one to finish passes it on to the next stage
+                stage.input.put(_END)
+                with stage._lock:
+                    stage._running -= 1
+                    last = stage._running == 0
+                if last:
+                    for output in outputs:
+                        output.put(_END)
+                return
+
+            start = time.perf_counter()
+            try:
+                results = stage.fn(item)
+                stage.latency.record(time.perf_counter() - start)
+                for result in results or ():
+                    for output in outputs:
+                        output.put(result)
+            except Exception as error:
+                logger.exception(f"Stage {stage.name} failed on an item: {error}")
+                with stage._lock:
+                    stage.errors += 1
+            else:
+                with stage._lock:
+                    stage.processed += 1
+
+
+def chunked(items, size):
+    # Group an iterable into lists of up to `size` items
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_email_pipeline(gmail_service, message_ids, sinks, pools, batch_size=GMAIL_BATCH_SIZE, queue_size=100,
+                       journal=None, cache=None, thread_mode=False, dedupe=False, max_body_bytes=MAX_BODY_BYTES):
+    """
+    Exports emails through a staged pipeline:
+    list IDs -> fetch -> parse -> one branch per sink.
+
+    Fetching uses as many workers as the Gmail pool and each sink as many as
+    its `workers`; parsing uses a single worker. Every sink receives every
+    email, so a fast local sink and the Google one run side by side.
+
+    Memory is bounded by the queues, not by the number of messages. The
+    parse queue holds fetched chunks of `batch_size` messages, so it is sized
+    to queue_size // batch_size chunks; one more chunk is held by each fetch
+    worker and by the parse worker. Each sink's queue holds up to queue_size
+    parsed emails. With the default sizes that is at most 11 chunks of 50
+    fetched messages plus 100 parsed emails per sink.
+
+    With a journal, messages whose export already finished are not fetched
+    again, and each sink is told the journal state of the ones it gets again
+    (see Sink.resume), so a rerun only does the remaining work. A message is
+    marked finished once every sink has reported it written.
+
+    In thread mode the emails of each fetched batch are grouped by threadId
+    and passed to the sinks together (see GoogleSink). With dedupe, emails
+    whose content (sender, recipients, date, subject and body) was already
+    exported under another message ID are dropped before any sink sees them.
+
+    Messages are fetched in full only if a sink needs their body (see
+    Sink.needs_body), e.g. to write a doc; the others are fetched with
+    format='metadata', which returns only the headers the rows are built
+    from. Dedupe compares bodies, so it always fetches messages in full.
+
+    Parameters:
+    - gmail_service: The Gmail API service instance.
+    - message_ids: Iterable of message IDs, e.g. from get_new_message_ids.
+    - sinks: List of Sink instances to write to, e.g. a GoogleSink.
+    - pools: An ApiWorkerPools instance providing the worker count of each stage.
+    - batch_size (int): Number of messages per Gmail batch request.
+    - queue_size (int): Capacity of the queue in front of each stage; the
+      parse queue's is counted in messages (see above).
+    - journal: An ExportJournal recording each message's progress, or None.
+    - cache: A MessageCache consulted before fetching messages from Gmail, or None.
+    - thread_mode (bool): Pass the emails of a thread to the sinks together.
+    - dedupe (bool): Skip emails whose content was already exported.
+    - max_body_bytes (int): Size cap for each email's body (see emails.MAX_BODY_BYTES).
+
+    Returns:
+    - Dictionary of per-stage 'processed' and 'errors' counts and 'latency'
+      summaries; each sink's stage is named 'write_<sink name>'.
+    """
+    # Content hashes seen in this run, when there is no journal to claim them in
+    seen_contents = {}
+    duplicates_skipped = [0]
+    # Number of sinks that have yet to report each email written
+    outstanding = {}
+    outstanding_lock = threading.Lock()
+
+    def on_done(message_ids):
+        finished = []
+        with outstanding_lock:
+            for message_id in message_ids:
+                remaining = outstanding.get(message_id)
+                if remaining is None:
+                    continue
+                if remaining > 1:
+                    outstanding[message_id] = remaining - 1
+                else:
+                    del outstanding[message_id]
+                    finished.append(message_id)
+        if finished:
+            journal.mark_rows_appended(finished)
+
+    if journal is not None:
+        for sink in sinks:
+            sink.on_done = on_done
+
+    def fetch(chunk):
+        if journal is not None:
+            states = journal.get_states(chunk)
+            chunk = [message_id for message_id in chunk
+                     if states.get(message_id, (None,))[0] not in DONE_STATES]
+            for sink in sinks:
+                sink.resume(states)
+            if not chunk:
+                return None
+        # Bodies are only fetched for the emails a sink writes them for
+        full_ids, metadata_ids = [], []
+        for message_id in chunk:
+            if dedupe or any(sink.needs_body(message_id) for sink in sinks):
+                full_ids.append(message_id)
+            else:
+                metadata_ids.append(message_id)
+        emails = fetch_messages_batch(gmail_service, full_ids, batch_size, cache=cache, max_body_bytes=max_body_bytes)
+        emails += fetch_messages_batch(gmail_service, metadata_ids, batch_size, cache=cache,
+                                       message_format='metadata')
+        if journal is not None:
+            journal.mark_fetched(email_data['id'] for email_data in emails)
+            # Messages deleted since they were listed are not fetched again
+            for message_id in set(chunk) - {email_data['id'] for email_data in emails}:
+                journal.mark_skipped(message_id)
+        return [(emails, set(metadata_ids))]
+
+    def parse_one(email_data, with_body=True):
+        email_info = parse_email_details(email_data, max_body_bytes, with_body)
+        # Emails without a readable body come back as None and are skipped
+        if email_info is None and journal is not None:
+            journal.mark_skipped(email_data['id'])
+        return email_info
+
+    def drop_duplicates(email_infos):
+        hashes = {email_info['id']: get_content_hash(email_info) for email_info in email_infos}
+        if journal is not None:
+            # Claimed in the journal, so copies exported by earlier runs count too
+            duplicates = journal.claim_contents(hashes)
+        else:
+            duplicates = {}
+            for message_id, content_hash in hashes.items():
+                owner = seen_contents.setdefault(content_hash, message_id)
+                if owner != message_id:
+                    duplicates[message_id] = owner
+        for message_id, owner in duplicates.items():
+            logger.debug(f"Skipping email {message_id}, a duplicate of {owner}")
+            if journal is not None:
+                journal.mark_skipped(message_id)
+        # Each duplicate would have had a doc of its own
+        if duplicates:
+            duplicates_skipped[0] += len(duplicates)
+            api_metrics.record_avoided('duplicate', len(duplicates))
+        return [email_info for email_info in email_infos if email_info['id'] not in duplicates]
+
+    def parse(fetched):
+        emails, metadata_ids = fetched
+        if thread_mode:
+            # Oldest first, so each thread reads in the order its emails arrived
+            emails = sorted(emails, key=lambda email_data: int(email_data.get('internalDate') or 0))
+        email_infos = [parse_one(email_data, email_data['id'] not in metadata_ids) for email_data in emails]
+        email_infos = [email_info for email_info in email_infos if email_info is not None]
+        if dedupe:
+            email_infos = drop_duplicates(email_infos)
+        if journal is not None:
+            with outstanding_lock:
+                outstanding.update((email_info['id'], len(sinks)) for email_info in email_infos)
+        if not thread_mode:
+            return [[email_info] for email_info in email_infos]
+        threads = {}
+        for email_info in email_infos:
+            threads.setdefault(email_info['thread_id'] or email_info['id'], []).append(email_info)
+        return list(threads.values())
+
+    pipeline = Pipeline(chunked(message_ids, batch_size), "list")
+    pipeline.add_stage("fetch", fetch, pools.size('gmail'), queue_size)
+    # Items here are whole fetched chunks, so the bound is counted in chunks
+    pipeline.add_stage("parse", parse, 1, max(1, queue_size // batch_size))
+    for sink in sinks:
+        pipeline.add_branch(f"write_{sink.name}", sink.write, sink.workers, queue_size)
+    try:
+        return pipeline.run()
+    finally:
+        # Buffered rows are written, and reported done, before the run returns
+        for sink in sinks:
+            sink.flush()
+        if dedupe:
+            logger.info(f"Skipped {duplicates_skipped[0]} duplicate emails")
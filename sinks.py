@@ -0,0 +1,360 @@
+import csv
+import io
+import json
+import os
+import re
+import threading
+from drive import LazyFolderDict, append_to_doc, build_doc_content, build_thread_content, create_doc_with_content, get_doc_link
+from folder_cache import FolderCache
+from helper import get_doc_title, get_main_path
+from journal import DOC_CREATED
+from logger import logger
+from metrics import api_metrics
+from spreadsheet import SpreadsheetRowWriter
+
+# Outputs run_email_pipeline can write to; several can be used at once
+SINKS = ('google', 'local')
+
+# Local exports: one file set per month, e.g. local_export/emails_2024_11.jsonl,
+# continued in emails_2024_11.1.jsonl once a file reaches LOCAL_MAX_FILE_BYTES
+LOCAL_EXPORT_DIR = 'local_export'
+LOCAL_FORMATS = ('jsonl', 'csv')
+LOCAL_FIELDS = ['id', 'thread_id', 'from', 'to', 'date', 'subject', 'message']
+LOCAL_FLUSH_SIZE = 1000
+LOCAL_MAX_FILE_BYTES = 256 * 1024 ** 2
+
+
+def build_sinks(outputs, sheet_service=None, drive_service=None, pools=None, journal=None, docs_service=None,
+                thread_mode=False, local_dir=LOCAL_EXPORT_DIR, local_format='jsonl', flush_interval=30,
+                folder_dict=None, write_docs=True):
+    """
+    Builds the sinks for a list of output names.
+
+    Parameters:
+    - outputs: Names from SINKS, e.g. ('google', 'local').
+    - sheet_service, drive_service, pools, journal, docs_service, thread_mode,
+      flush_interval, write_docs: For the 'google' sink (see GoogleSink).
+    - local_dir, local_format: For the 'local' sink (see LocalFileSink).
+    - folder_dict: Folder mapping for the 'google' sink (a LazyFolderDict
+      below get_main_path() if None).
+
+    Returns:
+    - List of Sink instances, in the order of `outputs`.
+    """
+    sinks = []
+    for output in outputs:
+        if output == 'google':
+            if folder_dict is None:
+                # Folders are created lazily, only for days that actually have mail
+                folder_dict = LazyFolderDict(FolderCache(drive_service, get_main_path()))
+            sinks.append(GoogleSink(sheet_service, drive_service, folder_dict, pools, journal,
+                                    docs_service, thread_mode, flush_interval, write_docs))
+        elif output == 'local':
+            sinks.append(LocalFileSink(local_dir, local_format))
+        else:
+            raise ValueError(f"Unknown output {output!r}, expected one of {SINKS}")
+    return sinks
+
+
+class Sink:
+    """
+    A destination for exported emails.
+
+    The pipeline calls write() from `workers` threads, each time with a list
+    of parsed emails (a single email, or the emails of one thread in thread
+    mode), and flush() at the end of every run. A sink reports the emails it
+    has durably written by calling `on_done(message_ids)`; the pipeline marks
+    an email finished in the journal once every sink has reported it.
+
+    An email's body is only fetched if some sink's needs_body() says so;
+    otherwise the sinks get its details without a 'message'.
+    """
+
+    name = 'sink'
+    workers = 1
+
+    def __init__(self):
+        self.on_done = None
+        self.written = 0
+        self._written_lock = threading.Lock()
+
+    def resume(self, states):
+        # Journal states, {message ID: (status, doc ID)}, of emails about to be exported again
+        pass
+
+    def needs_body(self, message_id):
+        return True
+
+    def write(self, email_infos):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def _count(self, email_infos):
+        with self._written_lock:
+            self.written += len(email_infos)
+
+    def _done(self, message_ids):
+        if self.on_done is not None:
+            self.on_done(message_ids)
+
+
+class GoogleSink(Sink):
+    """
+    Writes each email to a Google Doc in its day folder and a row linking to
+    it in the monthly spreadsheet.
+
+    In thread mode every thread gets a single doc: a new thread's emails are
+    written with one files().create, and emails of a thread that already has
+    a doc are appended to it with one documents().batchUpdate. Every email
+    still gets its own sheet row, linking to its thread's doc. The calls this
+    saves compared to one doc per email are recorded in
+    metrics.api_metrics.avoided_calls.
+
+    Without `write_docs` only the sheet rows are written, an index of From,
+    To and Date, so no message body has to be fetched; rows link to a doc
+    only if an earlier run created one.
+
+    Parameters:
+    - sheet_service, drive_service: API service instances.
+    - folder_dict: A LazyFolderDict mapping folder keys to folder IDs.
+    - pools: An ApiWorkerPools instance; docs are written by as many threads as its Drive pool.
+    - journal: An ExportJournal to record created docs in, or None.
+    - docs_service: The Docs API service instance, needed in thread mode.
+    - thread_mode (bool): Write one doc per thread instead of one per email.
+    - flush_interval (float): Seconds between sheet row appends (see SpreadsheetRowWriter).
+    - write_docs (bool): Write a doc for every email, not only its sheet row.
+    """
+
+    name = 'google'
+
+    def __init__(self, sheet_service, drive_service, folder_dict, pools, journal=None, docs_service=None,
+                 thread_mode=False, flush_interval=30, write_docs=True):
+        super().__init__()
+        if thread_mode and write_docs and docs_service is None:
+            raise ValueError("Thread mode needs the Docs service to append to thread docs")
+        self.drive_service = drive_service
+        self.docs_service = docs_service
+        self.folder_dict = folder_dict
+        self.journal = journal
+        self.thread_mode = thread_mode
+        self.write_docs = write_docs
+        self.workers = pools.size('drive')
+        # Spreadsheet rows are buffered and appended in bulk
+        self.row_writer = SpreadsheetRowWriter(
+            sheet_service, drive_service, folder_dict, flush_interval=flush_interval, on_flush=self._done)
+
+        # Docs created by earlier runs, by message ID
+        self._existing_docs = {}
+        # Thread docs created or found so far, by thread ID
+        self._thread_docs = {}
+        self._thread_locks = {}
+        self._lock = threading.Lock()
+        self.avoided_calls = 0
+
+    def resume(self, states):
+        self._existing_docs.update((message_id, doc_id) for message_id, (status, doc_id) in states.items()
+                                   if status == DOC_CREATED and doc_id)
+
+    def needs_body(self, message_id):
+        # Emails whose doc an earlier run created only need their row
+        return self.write_docs and message_id not in self._existing_docs
+
+    def write(self, email_infos):
+        if not self.write_docs:
+            links = {email_info['id']: self._existing_link(email_info) for email_info in email_infos}
+        elif self.thread_mode:
+            links = self._write_thread(email_infos)
+        else:
+            links = {email_info['id']: self._write_doc(email_info) for email_info in email_infos}
+        added, failed = [], []
+        for email_info in email_infos:
+            spreadsheet_id = self.row_writer.add_row(email_info, links[email_info['id']])
+            if spreadsheet_id is None or isinstance(spreadsheet_id, dict):
+                failed.append(email_info['id'])
+            else:
+                added.append(email_info)
+        self._count(added)
+        if failed:
+            # They stay unfinished in the journal, so the next run adds the missing rows
+            raise RuntimeError(f"No spreadsheet found for the rows of emails {', '.join(failed)}")
+
+    def _existing_link(self, email_info):
+        document_id = self._existing_docs.pop(email_info['id'], None)
+        return get_doc_link(document_id) if document_id else ''
+
+    def _write_doc(self, email_info):
+        document_id = self._existing_docs.pop(email_info['id'], None)
+        if document_id is None:
+            document_id = self.folder_dict.with_folder(
+                email_info['docs_folder_id_key'], lambda folder_id: create_doc_with_content(
+                    self.drive_service, folder_id, get_doc_title(email_info), build_doc_content(email_info)))
+            if self.journal is not None:
+                self.journal.mark_doc_created(email_info['id'], document_id)
+        return get_doc_link(document_id)
+
+    def _thread_lock(self, thread_id):
+        with self._lock:
+            return self._thread_locks.setdefault(thread_id, threading.Lock())
+
+    def _write_thread(self, email_infos):
+        thread_id = email_infos[0]['thread_id'] or email_infos[0]['id']
+        # Emails an earlier run already wrote only need their rows
+        links = {email_info['id']: get_doc_link(self._existing_docs.pop(email_info['id']))
+                 for email_info in email_infos if email_info['id'] in self._existing_docs}
+        pending = [email_info for email_info in email_infos if email_info['id'] not in links]
+        if not pending:
+            return links
+
+        # Another worker may be writing a batch of the same thread
+        with self._thread_lock(thread_id):
+            document_id = self._thread_docs.get(thread_id)
+            if document_id is None and self.journal is not None:
+                document_id = self.journal.get_thread_docs([thread_id]).get(thread_id)
+            content = build_thread_content(pending)
+            if document_id is None:
+                document_id = self.folder_dict.with_folder(
+                    pending[0]['docs_folder_id_key'], lambda folder_id: create_doc_with_content(
+                        self.drive_service, folder_id, get_doc_title(pending[0]), content))
+                if self.journal is not None:
+                    self.journal.set_thread_doc(thread_id, document_id)
+            else:
+                append_to_doc(self.docs_service, document_id, content)
+            self._thread_docs[thread_id] = document_id
+        if self.journal is not None:
+            for email_info in pending:
+                self.journal.mark_doc_created(email_info['id'], document_id)
+
+        # One call wrote every email of the batch
+        if len(pending) > 1:
+            with self._lock:
+                self.avoided_calls += len(pending) - 1
+            api_metrics.record_avoided('thread', len(pending) - 1)
+        links.update((email_info['id'], get_doc_link(document_id)) for email_info in pending)
+        return links
+
+    def flush(self):
+        self.row_writer.flush()
+        # Called at the end of every run. A sink kept across runs (see
+        # daemon.ExportDaemon) drops what it learned about the run's emails
+        # and threads; thread docs are looked up in the journal again
+        with self._lock:
+            self._existing_docs.clear()
+            self._thread_locks.clear()
+            if self.journal is not None:
+                self._thread_docs.clear()
+
+    def close(self):
+        self.row_writer.close()
+        if self.thread_mode and self.write_docs:
+            logger.info(f"Thread mode avoided {self.avoided_calls} doc writes")
+
+
+class LocalFileSink(Sink):
+    """
+    Writes emails to local files, one file set per month, for analytics or
+    testing without Google APIs.
+
+    Rows are buffered and appended with one write per month file every
+    `flush_size` emails; a file is continued in a new numbered part once it
+    reaches `max_file_bytes`. Emails are reported done only after their rows
+    have been written and fsynced. Delivery is at least once: an email whose
+    export to another sink was interrupted is written again on the rerun.
+
+    Parameters:
+    - directory (str): Directory for the files.
+    - file_format (str): 'jsonl' (one JSON object per line) or 'csv' (with a header row).
+    - fields (list): Keys of the parsed email written for each row.
+    - flush_size (int): Emails buffered before the files are appended to.
+    - max_file_bytes (int): Size at which a file is rotated.
+    """
+
+    name = 'local'
+
+    def __init__(self, directory=LOCAL_EXPORT_DIR, file_format='jsonl', fields=LOCAL_FIELDS,
+                 flush_size=LOCAL_FLUSH_SIZE, max_file_bytes=LOCAL_MAX_FILE_BYTES):
+        super().__init__()
+        if file_format not in LOCAL_FORMATS:
+            raise ValueError(f"Unknown format {file_format!r}, expected one of {LOCAL_FORMATS}")
+        self.directory = directory
+        self.file_format = file_format
+        self.fields = list(fields)
+        self.flush_size = flush_size
+        self.max_file_bytes = max_file_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Bodies are only fetched if they are written
+        self.with_body = 'message' in self.fields
+
+        self._buffers = {}  # month ('YYYY_MM') -> list of (email ID, row)
+        self._buffered_rows = 0
+        self._parts = {}  # month -> number of its current file part
+        self._lock = threading.RLock()
+
+    def needs_body(self, message_id):
+        return self.with_body
+
+    def write(self, email_infos):
+        with self._lock:
+            for email_info in email_infos:
+                month = self._get_month(email_info)
+                row = [email_info.get(field) or '' for field in self.fields]
+                self._buffers.setdefault(month, []).append((email_info['id'], row))
+            self._buffered_rows += len(email_infos)
+            if self._buffered_rows >= self.flush_size:
+                self.flush()
+        self._count(email_infos)
+
+    def flush(self):
+        with self._lock:
+            for month in list(self._buffers):
+                entries = self._buffers.pop(month)
+                self._buffered_rows -= len(entries)
+                self._append(month, [row for _, row in entries])
+                self._done([message_id for message_id, _ in entries])
+
+    def get_path(self, month, part=0):
+        suffix = f".{part}" if part else ""
+        return os.path.join(self.directory, f"emails_{month}{suffix}.{self.file_format}")
+
+    @staticmethod
+    def _get_month(email_info):
+        # 'spreadsheet_MM_YYYY' -> 'YYYY_MM', so the files sort by date
+        month, year = email_info['sheet_folder_id_key'][len("spreadsheet_"):].split("_")
+        return f"{year}_{month}"
+
+    def _current_part(self, month):
+        if month not in self._parts:
+            # Continue the last part an earlier run wrote
+            pattern = re.compile(rf"emails_{month}(?:\.(\d+))?\.{self.file_format}$")
+            parts = [int(match.group(1) or 0) for match in map(pattern.match, os.listdir(self.directory)) if match]
+            self._parts[month] = max(parts, default=0)
+        return self._parts[month]
+
+    def _append(self, month, rows):
+        path = self.get_path(month, self._current_part(month))
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size >= self.max_file_bytes:
+            self._parts[month] += 1
+            path = self.get_path(month, self._parts[month])
+            size = 0
+            logger.info(f"Continuing the {month} export in {path}")
+
+        buffer = io.StringIO()
+        if self.file_format == 'jsonl':
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(self.fields, row)), ensure_ascii=False))
+                buffer.write("\n")
+        else:
+            writer = csv.writer(buffer)
+            if size == 0:
+                writer.writerow(self.fields)
+            writer.writerows(rows)
+
+        with open(path, "a", encoding="utf-8", newline="") as file:
+            file.write(buffer.getvalue())
+            file.flush()
+            os.fsync(file.fileno())
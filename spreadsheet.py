@@ -1,4 +1,16 @@
+import threading
+import time
 from googleapiclient.errors import HttpError
+from concurrency import execute_request
+from helper import get_spreadsheet_file_name
+from logger import logger
+
+# Columns written for every email, followed by the document link
+SPREADSHEET_KEYS = ['from', 'to', 'date']
+SPREADSHEET_HEADERS = SPREADSHEET_KEYS + ['link']
+# Response fields read back: whether a sheet has any values, and where rows were appended
+VALUES_GET_FIELDS = "values"
+VALUES_APPEND_FIELDS = "updates/updatedRange"
 
 
 def create_spreadsheet_in_folder(drive_service, folder_id_dict, content_dict, spreadsheet_title="Spreadsheet Data"):
@@ -17,100 +29,210 @@ def create_spreadsheet_in_folder(drive_service, folder_id_dict, content_dict, sp
         sheet_folder_id_key = content_dict['sheet_folder_id_key']
         folder_id = folder_id_dict.get(sheet_folder_id_key)
         if folder_id is not None:
-            # Search for an existing spreadsheet with the given title in the specified folder
-            query = f"mimeType='application/vnd.google-apps.spreadsheet' and name='{
-                spreadsheet_title}' and '{folder_id}' in parents"
-            results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-            existing_files = results.get('files', [])
-
-            if existing_files:
-                # If an existing file is found, return its ID
-                spreadsheet_id = existing_files[0]['id']
-                print(f"Spreadsheet with title '{
-                      spreadsheet_title}' already exists. Using existing ID: {spreadsheet_id}")
-            else:
-                # If no existing file is found, create a new one
-                file_metadata = {
-                    'name': spreadsheet_title,
-                    'mimeType': 'application/vnd.google-apps.spreadsheet',
-                    # Place the file in the specified folder
-                    'parents': [folder_id]
-                }
-                # Create the spreadsheet in Google Drive
-                file = drive_service.files().create(body=file_metadata, fields='id').execute()
-                spreadsheet_id = file.get('id')
-                print(f"Spreadsheet created with ID: {
-                      spreadsheet_id} inside folder ID: {folder_id}")
-
-            return spreadsheet_id
+            # A folder deleted since it was cached is looked up again (see LazyFolderDict.with_folder)
+            return folder_id_dict.with_folder(sheet_folder_id_key, lambda folder_id: _find_or_create_spreadsheet(
+                drive_service, folder_id, spreadsheet_title))
         else:
             return {'info': 'No sheet data available for this month'}
 
     except HttpError as e:
-        print(f"Error creating or fetching spreadsheet: {e}")
+        logger.error(f"Error creating or fetching spreadsheet: {e}")
         return None
     except Exception as e:
-        print(f"Unexpected error: {e}")
+        logger.exception(f"Unexpected error: {e}")
         return None
 
 
-def write_data_to_spreadsheet(sheet_service, spreadsheet_id, data, link, range_name="Sheet1!A1"):
-    """
-    Appends specific fields from a single dictionary to a Google Spreadsheet, adding headers only if the sheet is empty.
+def _find_or_create_spreadsheet(drive_service, folder_id, spreadsheet_title):
+    # Search for an existing spreadsheet with the given title in the specified folder
+    query = f"mimeType='application/vnd.google-apps.spreadsheet' and name='{
+        spreadsheet_title}' and '{folder_id}' in parents and trashed=false"
+    results = execute_request(
+        drive_service.files().list(q=query, fields="files(id, name)"))
+    existing_files = results.get('files', [])
+
+    if existing_files:
+        # If an existing file is found, return its ID
+        spreadsheet_id = existing_files[0]['id']
+        logger.info(f"Spreadsheet with title '{
+            spreadsheet_title}' already exists. Using existing ID: {spreadsheet_id}")
+    else:
+        # If no existing file is found, create a new one
+        file_metadata = {
+            'name': spreadsheet_title,
+            'mimeType': 'application/vnd.google-apps.spreadsheet',
+            # Place the file in the specified folder
+            'parents': [folder_id]
+        }
+        # Create the spreadsheet in Google Drive
+        file = execute_request(
+            drive_service.files().create(body=file_metadata, fields='id'))
+        spreadsheet_id = file.get('id')
+        logger.info(f"Spreadsheet created with ID: {
+            spreadsheet_id} inside folder ID: {folder_id}")
+    return spreadsheet_id
 
-    Parameters:
-    - spreadsheet_id: The ID of the spreadsheet where the data will be written.
-    - data: A dictionary to write to the spreadsheet.
-    - link: An external link to add alongside the data.
-    - range_name: The range in the spreadsheet to start writing (default is "Sheet1!A1").
 
-    Returns:
-    - The updated range where the data was written.
+def ensure_header_row(sheet_service, spreadsheet_id, range_name="Sheet1!A1"):
     """
-    try:
-        # Specify the keys to include from the dictionary and set up headers
-        keys_to_include = ['from', 'to', 'date']
-        headers = keys_to_include + ['link']
+    Writes the header row to a spreadsheet if it is still empty.
 
-        # Check if the spreadsheet already has data
-        existing_data = sheet_service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range=range_name
-        ).execute()
+    Returns:
+    - True if the header row was added.
+    """
+    existing_data = execute_request(sheet_service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=range_name,
+        fields=VALUES_GET_FIELDS
+    ))
+    if existing_data.get('values'):
+        return False
+    execute_request(sheet_service.spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id,
+        range=range_name,
+        valueInputOption="RAW",
+        insertDataOption="INSERT_ROWS",
+        body={'values': [SPREADSHEET_HEADERS]},
+        fields=VALUES_APPEND_FIELDS
+    ))
+    return True
+
+
+class SpreadsheetRowWriter:
+    """
+    Buffers spreadsheet rows in memory and appends them in bulk.
 
-        # Prepare the values to append
-        row_values = [[data.get(key, '')
-                       for key in keys_to_include] + [link or '']]
+    Each monthly spreadsheet ID is resolved once, and its header row is
+    checked once, instead of on every email. Rows are flushed with a single
+    values().append per spreadsheet when `flush_size` rows are buffered, when
+    `flush_interval` seconds have passed since the last flush, and on close().
 
-        # If the sheet is empty, prepend headers
-        if 'values' not in existing_data or not existing_data['values']:
-            values = [headers] + row_values
-        else:
-            values = row_values  # No headers if data already exists
+    `on_flush(message_ids)`, if given, is called with the IDs of the emails
+    whose rows have just been appended.
+    """
 
-        # Specify the request body with the values to append
-        body = {
-            'values': values
-        }
+    def __init__(self, sheet_service, drive_service, folder_id_dict, flush_size=500, flush_interval=30, range_name="Sheet1!A1", on_flush=None):
+        self.sheet_service = sheet_service
+        self.drive_service = drive_service
+        self.folder_id_dict = folder_id_dict
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.range_name = range_name
+        self.on_flush = on_flush
+
+        self._spreadsheet_ids = {}  # sheet_folder_id_key -> spreadsheet ID
+        self._checked_headers = set()
+        self._buffers = {}  # spreadsheet ID -> list of (email ID, row)
+        self._buffered_rows = 0
+        self._last_flush = time.monotonic()
+        # Guards the buffers only; it is never held during an API call
+        self._lock = threading.Lock()
+        # Flushes run one at a time, so rows keep their order and a new
+        # spreadsheet gets a single header row
+        self._flush_lock = threading.Lock()
+        self._spreadsheet_lock = threading.Lock()
+
+    def add_row(self, content_dict, link):
+        """
+        Buffers one row for the monthly spreadsheet of an email.
+
+        Parameters:
+        - content_dict: Email details as returned by parse_email_details.
+        - link: The link to the email's document.
+
+        Returns:
+        - The spreadsheet ID the row will be written to, or a dictionary with
+          an 'info' key if the month has no spreadsheet folder.
+        """
+        spreadsheet_id = self._get_spreadsheet_id(content_dict)
+        if spreadsheet_id is None or isinstance(spreadsheet_id, dict):
+            return spreadsheet_id
 
-        # Use the Sheets API to append the data to the spreadsheet
-        request = sheet_service.spreadsheets().values().append(
+        row = [content_dict.get(key, '') for key in SPREADSHEET_KEYS] + [link or '']
+        with self._lock:
+            self._buffers.setdefault(spreadsheet_id, []).append((content_dict.get('id'), row))
+            self._buffered_rows += 1
+        self.flush_if_due()
+        return spreadsheet_id
+
+    def flush_if_due(self):
+        # Flush when either the size or the time threshold has been reached,
+        # unless another thread is already flushing
+        if self._buffered_rows >= self.flush_size or \
+                time.monotonic() - self._last_flush >= self.flush_interval:
+            if self._flush_lock.acquire(blocking=False):
+                try:
+                    self._flush()
+                finally:
+                    self._flush_lock.release()
+
+    def flush(self):
+        """
+        Appends every buffered row, using one values().append per spreadsheet.
+        Rows that fail to be written stay buffered for the next flush.
+        """
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        # The buffers are swapped out, so add_row is not blocked by the appends
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+            self._last_flush = time.monotonic()
+        for spreadsheet_id, entries in buffers.items():
+            try:
+                self._append_rows(spreadsheet_id, [row for _, row in entries])
+            except HttpError as err:
+                logger.error(f"Failed to append {len(entries)} rows to spreadsheet {spreadsheet_id}: {err}")
+                with self._lock:
+                    # Ahead of the rows added since
+                    self._buffers[spreadsheet_id] = entries + self._buffers.get(spreadsheet_id, [])
+                continue
+            with self._lock:
+                self._buffered_rows -= len(entries)
+            if self.on_flush is not None:
+                self.on_flush([message_id for message_id, _ in entries])
+
+    def close(self):
+        self.flush()
+        if self._buffered_rows:
+            logger.error(f"{self._buffered_rows} spreadsheet rows could not be written")
+
+    def _get_spreadsheet_id(self, content_dict):
+        sheet_folder_id_key = content_dict['sheet_folder_id_key']
+        if sheet_folder_id_key not in self._spreadsheet_ids:
+            with self._spreadsheet_lock:
+                if sheet_folder_id_key not in self._spreadsheet_ids:
+                    # Name the spreadsheet after the email's month, not the current one
+                    month = sheet_folder_id_key.split("_")[1]
+                    spreadsheet_id = create_spreadsheet_in_folder(
+                        self.drive_service, self.folder_id_dict, content_dict,
+                        get_spreadsheet_file_name(int(month) if month.isdigit() else None))
+                    if spreadsheet_id is None:
+                        # Lookup failed, try again for the next email
+                        return None
+                    self._spreadsheet_ids[sheet_folder_id_key] = spreadsheet_id
+        return self._spreadsheet_ids[sheet_folder_id_key]
+
+    def _append_rows(self, spreadsheet_id, rows):
+        values = rows
+        if spreadsheet_id not in self._checked_headers:
+            # Check once whether the spreadsheet is empty and needs a header row
+            existing_data = execute_request(self.sheet_service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=self.range_name,
+                fields=VALUES_GET_FIELDS
+            ))
+            if 'values' not in existing_data or not existing_data['values']:
+                values = [SPREADSHEET_HEADERS] + rows
+
+        response = execute_request(self.sheet_service.spreadsheets().values().append(
             spreadsheetId=spreadsheet_id,
-            range=range_name,
+            range=self.range_name,
             valueInputOption="RAW",
             insertDataOption="INSERT_ROWS",
-            body=body
-        )
-        response = request.execute()
-
-        # Print the updated range if available
-        updated_range = response.get('updates', {}).get('updatedRange', None)
-        if updated_range:
-            print(f"Data appended to range: {updated_range}")
-        else:
-            print("No updatedRange returned in the response.")
-        return updated_range
-
-    except HttpError as err:
-        print(f"An error occurred: {err}")
-        return None
+            body={'values': values},
+            fields=VALUES_APPEND_FIELDS
+        ))
+        self._checked_headers.add(spreadsheet_id)
+        logger.info(f"Appended {len(rows)} rows to range: {response.get('updates', {}).get('updatedRange')}")
@@ -0,0 +1,29 @@
+from sqlalchemy import create_engine, event
+
+# Shared setup of the local SQLite files (the export journal and the message cache)
+
+# SQLite limits the number of bound parameters per statement
+QUERY_CHUNK_SIZE = 500
+
+
+def create_sqlite_engine(path):
+    """
+    Creates a SQLAlchemy engine for a local SQLite file.
+
+    Parameters:
+    - path (str): Path of the database file.
+
+    Returns:
+    - The engine, with every connection using WAL journaling.
+    """
+    engine = create_engine(f"sqlite:///{path}", connect_args={'timeout': 30})
+    event.listen(engine, "connect", _configure_connection)
+    return engine
+
+
+def _configure_connection(connection, record):
+    # WAL lets readers run alongside the writer; NORMAL sync is safe with WAL
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
@@ -0,0 +1,131 @@
+import base64
+import random
+from datetime import datetime, timedelta, timezone
+
+# Builds synthetic Gmail message resources (as returned by
+# users().messages().get with format='full') for benchmarks and offline runs.
+
+MESSAGE_SHAPES = ['plain', 'alternative', 'nested', 'html_only', 'latin1', 'single_part', 'many_recipients']
+# Shapes only built on request: a body Gmail stores behind an attachmentId,
+# as it does for large newsletters
+ATTACHED_BODY_SHAPES = ['attached_body']
+
+_WORDS = ("invoice meeting schedule report update please review attached project "
+          "deadline thanks regards team client weekly summary status action").split()
+
+
+def _encode(text, charset="utf-8"):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii')
+
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def _leaf(mime_type, text, charset="utf-8"):
+    return {
+        'mimeType': mime_type,
+        'filename': '',
+        'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}],
+        'body': {'size': len(text), 'data': _encode(text, charset)},
+    }
+
+
+def _attached_leaf(mime_type, text, attachment_id):
+    # The data is kept under '_data' for the fake attachments().get to return
+    leaf = _leaf(mime_type, text)
+    leaf['body'] = {'size': leaf['body']['size'], 'attachmentId': attachment_id, '_data': leaf['body']['data']}
+    return leaf
+
+
+def _multipart(mime_type, parts):
+    return {'mimeType': mime_type, 'filename': '', 'headers': [], 'body': {'size': 0}, 'parts': parts}
+
+
+def _attachment(rng):
+    return {
+        'mimeType': 'application/pdf',
+        'filename': f'report_{rng.randint(1, 999)}.pdf',
+        'headers': [],
+        'body': {'size': 1024, 'attachmentId': f'att{rng.randint(1, 10 ** 9)}'},
+    }
+
+
+def make_message(index, shape=None, body_size=2000, seed=None, date=None, thread_size=1):
+    """
+    Builds one synthetic Gmail message resource.
+
+    Parameters:
+    - index (int): Used for the message ID and to vary the content.
+    - shape (str): One of MESSAGE_SHAPES or ATTACHED_BODY_SHAPES (random from MESSAGE_SHAPES if None).
+    - body_size (int): Approximate body length in characters.
+    - seed: Seed for the random generator (defaults to `index`).
+    - date (datetime): Value of the Date header (derived from `index` if None).
+    - thread_size (int): Number of consecutive messages sharing a threadId.
+
+    Returns:
+    - A dictionary shaped like a Gmail message resource.
+    """
+    rng = random.Random(index if seed is None else seed)
+    shape = shape or rng.choice(MESSAGE_SHAPES)
+    if date is None:
+        date = datetime(2024, 11, 14, tzinfo=timezone.utc) + timedelta(minutes=index)
+    text = _text(rng, body_size)
+
+    recipients = 40 if shape == 'many_recipients' else rng.randint(1, 3)
+    headers = [
+        {'name': 'Delivered-To', 'value': 'me@example.com'},
+        {'name': 'Received', 'value': 'from mail.example.com by mx.google.com'},
+        {'name': 'From', 'value': f'Sender {index} <sender{index}@example.com>'},
+        {'name': 'To', 'value': ", ".join(f'User {n} <user{n}@example.com>' for n in range(recipients))},
+        {'name': 'Cc', 'value': f'Copy <cc{index}@example.com>'},
+        {'name': 'Subject', 'value': f'Synthetic message {index}'},
+        {'name': 'Date', 'value': date.strftime('%a, %d %b %Y %H:%M:%S %z')},
+        {'name': 'Message-ID', 'value': f'<{index}@example.com>'},
+        {'name': 'Content-Type', 'value': 'multipart/mixed; boundary="b"'},
+    ]
+
+    html = f"<html><body><p>{text}</p></body></html>"
+    if shape in ('plain', 'many_recipients'):
+        payload = _multipart('multipart/mixed', [_leaf('text/plain', text), _attachment(rng)])
+    elif shape == 'alternative':
+        payload = _multipart('multipart/alternative', [_leaf('text/plain', text), _leaf('text/html', html)])
+    elif shape == 'nested':
+        # mixed > related > alternative > text, deeper than the old two-level walker reached
+        alternative = _multipart('multipart/alternative', [_leaf('text/html', html), _leaf('text/plain', text)])
+        related = _multipart('multipart/related', [alternative, _attachment(rng)])
+        payload = _multipart('multipart/mixed', [_multipart('multipart/mixed', [related]), _attachment(rng)])
+    elif shape == 'html_only':
+        payload = _multipart('multipart/mixed', [_leaf('text/html', html)])
+    elif shape == 'latin1':
+        payload = _multipart('multipart/alternative', [_leaf('text/plain', text + " café déjà vu", 'iso-8859-1')])
+    elif shape == 'single_part':
+        payload = _leaf('text/plain', text)
+    elif shape == 'attached_body':
+        payload = _multipart('multipart/alternative', [_attached_leaf('text/plain', text, f'body{index}'),
+                                                       _attached_leaf('text/html', html, f'html{index}')])
+    else:
+        raise ValueError(f"Unknown message shape: {shape}")
+
+    payload['headers'] = headers + payload['headers']
+    return {
+        'id': f'msg{index:08d}',
+        'threadId': f'thr{index // max(1, thread_size):08d}',
+        'labelIds': ['INBOX'],
+        'snippet': text[:100],
+        'sizeEstimate': body_size,
+        'internalDate': str(int(date.timestamp() * 1000)),
+        'payload': payload,
+    }
+
+
+def make_corpus(count, shapes=None, body_size=2000):
+    # A list of `count` messages cycling through the given shapes
+    shapes = shapes or MESSAGE_SHAPES
+    return [make_message(index, shapes[index % len(shapes)], body_size) for index in range(count)]
@@ -0,0 +1,71 @@
+import math
+import os
+import tempfile
+import unittest
+from concurrency import API_RATE_LIMITS, set_rate_limit
+from emails import GMAIL_MAX_BATCH_SIZE, fetch_messages_batch
+from fake_services import FakeGoogleServices
+from message_cache import MessageCache
+
+# Run with: python -m unittest test_emails
+
+
+def setUpModule():
+    # Only call counts matter here, not the Gmail quota
+    set_rate_limit('gmail', 1e9)
+
+
+def tearDownModule():
+    set_rate_limit('gmail', API_RATE_LIMITS['gmail'])
+
+
+class FetchMessagesBatchTest(unittest.TestCase):
+    def fetch(self, count, batch_size):
+        fake = FakeGoogleServices(message_count=count)
+        gmail_service = fake.services()[0]
+        message_ids = [f'msg{index:08d}' for index in range(count)]
+        messages = fetch_messages_batch(gmail_service, message_ids, batch_size)
+        return fake, message_ids, messages
+
+    def test_fetches_n_messages_in_ceil_n_over_batch_size_requests(self):
+        for count, batch_size in [(1, 50), (50, 50), (120, 50), (120, 7)]:
+            with self.subTest(count=count, batch_size=batch_size):
+                fake, message_ids, messages = self.fetch(count, batch_size)
+                self.assertEqual(fake.call_counts['gmail.batch'], math.ceil(count / batch_size))
+                self.assertEqual(fake.call_counts['batch:gmail.users.messages.get'], count)
+                # No messages().get outside a batch
+                self.assertEqual(fake.call_counts['gmail.users.messages.get'], 0)
+                self.assertEqual([message['id'] for message in messages], message_ids)
+
+    def test_batch_size_is_capped_at_gmail_maximum(self):
+        fake, _, _ = self.fetch(250, 500)
+        self.assertEqual(fake.call_counts['gmail.batch'], math.ceil(250 / GMAIL_MAX_BATCH_SIZE))
+
+    def test_deleted_message_is_dropped(self):
+        fake = FakeGoogleServices(message_count=10)
+        fake.delete_messages(['msg00000003'])
+        message_ids = [f'msg{index:08d}' for index in range(10)]
+        messages = fetch_messages_batch(fake.services()[0], message_ids, 50)
+        self.assertEqual([message['id'] for message in messages],
+                         [message_id for message_id in message_ids if message_id != 'msg00000003'])
+
+    def test_cached_messages_keep_their_downloaded_body(self):
+        fake = FakeGoogleServices(message_count=5, shapes=['attached_body'])
+        gmail_service = fake.services()[0]
+        message_ids = [f'msg{index:08d}' for index in range(5)]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MessageCache(os.path.join(directory, 'message_cache.db'))
+            try:
+                first = fetch_messages_batch(gmail_service, message_ids, cache=cache)
+                self.assertEqual(fake.call_counts['gmail.users.messages.attachments.get'], 5)
+                second = fetch_messages_batch(gmail_service, message_ids, cache=cache)
+            finally:
+                cache.close()
+        # Served from the cache, bodies included
+        self.assertEqual(fake.call_counts['gmail.batch'], 1)
+        self.assertEqual(fake.call_counts['gmail.users.messages.attachments.get'], 5)
+        self.assertEqual(second, first)
+
+
+if __name__ == "__main__":
+    unittest.main()
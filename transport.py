@@ -0,0 +1,151 @@
+import threading
+import httplib2
+import requests
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import DEFAULT_HTTP_TIMEOUT_SEC
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from metrics import api_metrics
+
+# HTTP transports for the API clients. googleapiclient expects an
+# httplib2.Http-like object; httplib2 itself cannot be shared between threads.
+#
+#   'pooled'      one requests Session whose keep-alive connection pools are
+#                 shared by every worker thread (default)
+#   'per-thread'  a separate httplib2.Http, with its own connections, per thread
+TRANSPORTS = ('pooled', 'per-thread')
+DEFAULT_TRANSPORT = 'pooled'
+
+# Keep-alive connections kept per host; enough for every pipeline worker
+# thread (see concurrency.API_POOL_SIZES) to call the same host at once
+POOL_MAXSIZE = 32
+# Number of hosts to keep a connection pool for
+POOL_CONNECTIONS = 8
+
+
+def _count_new_connection(pool_class):
+    # A connection pool class that reports every connection it opens
+    class CountingConnectionPool(pool_class):
+        def _new_conn(self):
+            api_metrics.record_connection_opened()
+            return super()._new_conn()
+
+    CountingConnectionPool.__name__ = f"Counting{pool_class.__name__}"
+    return CountingConnectionPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _count_new_connection(HTTPConnectionPool),
+            'https': _count_new_connection(HTTPSConnectionPool),
+        }
+
+
+class PooledHttp:
+    """
+    httplib2.Http-compatible transport backed by a requests Session.
+
+    Connections are kept alive in per-host pools shared by all threads, so
+    workers reuse each other's connections instead of each paying for its
+    own TLS handshakes. Every connection opened is recorded in
+    metrics.api_metrics, from which the connection reuse ratio is derived.
+
+    Parameters:
+    - pool_maxsize (int): Keep-alive connections kept per host.
+    - pool_connections (int): Number of hosts to keep a pool for.
+    - pool_block (bool): Make threads wait for a free connection instead of
+      opening extra ones that are closed after use.
+    - timeout (float): Seconds to wait for the server, googleapiclient's 60 by
+      default. None waits forever, so a stalled connection would block its thread for good.
+    """
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE, pool_connections=POOL_CONNECTIONS, pool_block=True,
+                 timeout=DEFAULT_HTTP_TIMEOUT_SEC):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = _CountingAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        reply = self.session.request(method, uri, data=body, headers=headers,
+                                     timeout=self.timeout, allow_redirects=redirections > 0)
+        content = reply.content
+        info = {key.lower(): value for key, value in reply.headers.items()}
+        info['status'] = str(reply.status_code)
+        if 'content-encoding' in info:
+            # requests has already decompressed the content; record it the way httplib2 does
+            info['-content-encoding'] = info.pop('content-encoding')
+            info['content-length'] = str(len(content))
+        response = httplib2.Response(info)
+        response.reason = reply.reason
+
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        api_metrics.record_transfer(sent, len(content))
+        return response, content
+
+    def close(self):
+        self.session.close()
+
+
+def build_authorized_http(creds):
+    # A fresh authorized Http object; httplib2 objects must not be shared between threads.
+    # Same timeout as googleapiclient's build_http
+    return AuthorizedHttp(creds, http=httplib2.Http(timeout=DEFAULT_HTTP_TIMEOUT_SEC))
+
+
+def _open_sockets(http):
+    return {id(connection.sock) for connection in http.connections.values()
+            if getattr(connection, 'sock', None) is not None}
+
+
+class ThreadLocalHttp:
+    """
+    Http-like object that gives every thread its own AuthorizedHttp, so a
+    single service object can be shared by worker threads.
+    """
+
+    def __init__(self, creds):
+        self.credentials = creds
+        self._local = threading.local()
+
+    def _get_http(self):
+        if not hasattr(self._local, 'http'):
+            self._local.http = build_authorized_http(self.credentials)
+        return self._local.http
+
+    def request(self, uri, method="GET", body=None, *args, **kwargs):
+        http = self._get_http()
+        sockets = _open_sockets(http.http)
+        response, content = http.request(uri, method, body, *args, **kwargs)
+        # A socket that was not open before the request is a new connection
+        for _ in _open_sockets(http.http) - sockets:
+            api_metrics.record_connection_opened()
+        # Attributed to the call in progress on this thread (see metrics.ApiMetrics)
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        api_metrics.record_transfer(sent, len(content or b""))
+        return response, content
+
+
+def build_transport(creds, transport=DEFAULT_TRANSPORT, **pool_options):
+    """
+    Builds the Http object shared by the API clients.
+
+    Parameters:
+    - creds: Credentials to authorize requests with.
+    - transport (str): One of TRANSPORTS.
+    - pool_options: Keyword arguments for PooledHttp (pool_maxsize, timeout, ...).
+
+    Returns:
+    - An httplib2.Http-like object that is safe to use from several threads.
+    """
+    if transport == 'pooled':
+        # AuthorizedHttp itself holds no connection state, so one instance can be shared
+        return AuthorizedHttp(creds, http=PooledHttp(**pool_options))
+    if transport == 'per-thread':
+        return ThreadLocalHttp(creds)
+    raise ValueError(f"Unknown transport {transport!r}, expected one of {TRANSPORTS}")